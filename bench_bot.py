@@ -0,0 +1,419 @@
+# bench_bot.py
+#
+# Offline load test for bot_13.py. Starts local stand-ins for CRYPTO_API,
+# GOLD_API and the Telegram Bot API, imports the bot against them, replays
+# webhook updates at a fixed rate and reports, per command:
+#   throughput, p50/p95/p99 handler latency (webhook POST -> first outbound
+#   Telegram call for that chat), upstream calls, Telegram calls, RSS growth.
+#
+#   python bench_bot.py                                  # default command mix
+#   python bench_bot.py --commands top,cb:goldprice --count 500 --rate 100
+#   python bench_bot.py --updates recorded.jsonl --rate 20
+#   python bench_bot.py --upstream-latency 0.3 --error-rate 0.1 --json out.json
+#   python bench_bot.py --startup 5 --max-startup-ms 3000   # cold-start only
+#
+# Nothing leaves 127.0.0.1, so it runs in CI.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiohttp import ClientSession, web
+
+TOKEN = "123456:BENCH"
+SECRET = "bench-secret"
+DEFAULT_COMMANDS = "top,search,goldprice,excel_file,cb:top,cb:goldprice"
+HEAVY_MODULES = ("numpy", "openpyxl", "pandas", "pyarrow")  # must not load on import
+
+# Runs in a fresh interpreter: time `import bot_13` and until it reports ready.
+STARTUP_PROBE = f'''
+import json, sys, time
+t0 = time.perf_counter()
+import bot_13
+imported = time.perf_counter()
+heavy = sorted(m for m in {HEAVY_MODULES!r} if m in sys.modules)
+while not bot_13._ready and time.perf_counter() - t0 < 30:
+    time.sleep(0.005)
+print(json.dumps({{"import_ms": (imported - t0) * 1000,
+                  "ready_ms": (time.perf_counter() - t0) * 1000 if bot_13._ready else None,
+                  "heavy_modules": heavy}}))
+'''
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _pct(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# --Fake upstreams
+class FakeServers:
+    def __init__(self, latency: float, error_rate: float, coins: int):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.coins = coins
+        self.calls: Dict[str, int] = {}
+        self.replies: Dict[int, float] = {}   # chat_id -> time of first outbound call
+        self.message_id = 0
+
+    def _count(self, key: str) -> None:
+        self.calls[key] = self.calls.get(key, 0) + 1
+
+    async def _upstream(self, key: str) -> Optional[web.Response]:
+        self._count(key)
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.error_rate:
+            self._count(f"{key}_errors")
+            return web.Response(status=502, text="injected error")
+        return None
+
+    async def crypto(self, request: web.Request) -> web.Response:
+        err = await self._upstream("crypto")
+        if err:
+            return err
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        data = [
+            {
+                "title": f"Coin {i}", "symbol": sym, "p": f"{1000 + i * 1.5:.2f}",
+                "p_irr": f"{(1000 + i * 1.5) * 60000:,.0f}", "volume": str(i * 1000),
+                "d": "1.2", "dp": "0.5", "datetime": stamp,
+                "cr": {"highest-24h-usd": "1", "highest-7d-usd": "2", "volatility-usd": "0.1"},
+            }
+            for i, sym in enumerate(["BTC", "ETH", "USDT"] + [f"C{i:04d}" for i in range(self.coins - 3)])
+        ]
+        return web.json_response({"data": data})
+
+    async def gold(self, request: web.Request) -> web.Response:
+        err = await self._upstream("gold")
+        if err:
+            return err
+        import bot_13
+        keys = {k for _, hdr, rows in bot_13.GOLD_VIEWS.values() for k in [hdr] + [r for _, r in rows]}
+        stamp = time.strftime("%H:%M:%S")
+        return web.json_response(
+            {"current": {k: {"p": f"{random.randint(10**6, 10**8):,}", "t": stamp, "ts": stamp} for k in keys}}
+        )
+
+    async def telegram(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self._count(f"tg:{method}")
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        # inline answers carry no chat; the bench uses the chat id as the query id
+        chat_id = params.get("chat_id", params.get("inline_query_id"))
+        if chat_id is not None:
+            self.replies.setdefault(int(chat_id), time.perf_counter())
+        if method == "getMe":
+            result: Any = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif method in ("sendMessage", "sendDocument", "editMessageText"):
+            self.message_id += 1
+            result = {
+                "message_id": self.message_id, "date": int(time.time()),
+                "chat": {"id": int(chat_id or 0), "type": "private"}, "text": str(params.get("text", "")),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/crypto", self.crypto)
+        app.router.add_get("/gold", self.gold)
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        return app
+
+
+def _serve_in_thread(make_app, port: int) -> None:
+    # Run an aiohttp app on its own loop so it never competes with the load generator.
+    ready = threading.Event()
+
+    def run() -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = make_app()
+        if asyncio.iscoroutine(app):
+            app = loop.run_until_complete(app)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait(10)
+
+
+# --Updates
+def _message_update(uid: int, chat_id: int, text: str) -> Dict[str, Any]:
+    cmd = text.split()[0]
+    return {
+        "update_id": uid,
+        "message": {
+            "message_id": uid, "date": int(time.time()), "text": text,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(cmd)}],
+        },
+    }
+
+
+def _callback_update(uid: int, chat_id: int, data: str) -> Dict[str, Any]:
+    user = {"id": chat_id, "is_bot": False, "first_name": "bench"}
+    return {
+        "update_id": uid,
+        "callback_query": {
+            "id": str(uid), "from": user, "chat_instance": "bench", "data": data,
+            "message": {
+                "message_id": 1, "date": int(time.time()), "text": "menu",
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+            },
+        },
+    }
+
+
+def _inline_update(uid: int, chat_id: int, query: str) -> Dict[str, Any]:
+    return {
+        "update_id": uid,
+        "inline_query": {
+            "id": str(chat_id), "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "query": query, "offset": "",
+        },
+    }
+
+
+def synth_updates(command: str, count: int, first_uid: int) -> List[Tuple[str, Dict[str, Any]]]:
+    out = []
+    for k in range(count):
+        uid = first_uid + k
+        chat_id = 10_000_000 + uid  # one chat per update so replies can be matched
+        if command.startswith("cb:"):
+            out.append((command, _callback_update(uid, chat_id, command[3:])))
+        elif command.startswith("inline:"):
+            out.append((command, _inline_update(uid, chat_id, command[7:])))
+        else:
+            text = {"search": "/search BTC", "history": "/history BTC 1m"}.get(command, f"/{command}")
+            out.append((command, _message_update(uid, chat_id, text)))
+    return out
+
+
+def load_updates(path: str, first_uid: int) -> List[Tuple[str, Dict[str, Any]]]:
+    # Recorded updates get fresh update_ids and chat ids so replies can be matched.
+    out = []
+    with open(path, encoding="utf-8") as f:
+        for k, line in enumerate(l for l in f if l.strip()):
+            upd = json.loads(line)
+            uid = first_uid + k
+            chat_id = 10_000_000 + uid
+            upd["update_id"] = uid
+            if "callback_query" in upd:
+                cq = upd["callback_query"]
+                cq["id"] = str(uid)
+                cq.setdefault("message", {}).setdefault("chat", {})["id"] = chat_id
+                label = f"cb:{cq.get('data', '')}"
+            else:
+                msg = upd.get("message") or upd.get("edited_message") or {}
+                msg.setdefault("chat", {})["id"] = chat_id
+                label = (msg.get("text") or "other").split()[0].lstrip("/").split("@")[0]
+            out.append((label, upd))
+    return out
+
+
+# --Cold start
+def run_startup(runs: int, max_ms: Optional[float]) -> int:
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", STARTUP_PROBE], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=60)
+        if out.returncode:
+            print(out.stderr[-2000:], file=sys.stderr)
+            return 2
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    import_ms = statistics.median(s["import_ms"] for s in samples)
+    ready = [s["ready_ms"] for s in samples if s["ready_ms"] is not None]
+    ready_ms = statistics.median(ready) if ready else float("inf")
+    heavy = sorted({m for s in samples for m in s["heavy_modules"]})
+    print(f"cold start over {runs} runs: import {import_ms:.0f} ms, ready {ready_ms:.0f} ms (median)")
+    if heavy:
+        print(f"FAIL: heavy modules loaded at import: {', '.join(heavy)}", file=sys.stderr)
+        return 1
+    if max_ms and ready_ms > max_ms:
+        print(f"FAIL: ready in {ready_ms:.0f} ms (limit {max_ms:.0f})", file=sys.stderr)
+        return 1
+    return 0
+
+
+# --Load generator
+async def run_phase(name: str, updates, url: str, rate: float, fakes: FakeServers,
+                    timeout: float) -> Dict[str, Any]:
+    calls_before = dict(fakes.calls)
+    rss_before = _rss_mb()
+    sent: Dict[int, Tuple[str, float]] = {}
+    statuses: Dict[int, int] = {}
+    headers = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+
+    async with ClientSession() as http:
+        async def post(label: str, upd: Dict[str, Any]) -> None:
+            chat = (upd.get("message") or upd.get("callback_query", {}).get("message") or {}).get("chat", {})
+            chat_id = chat.get("id") or int(upd.get("inline_query", {}).get("id", 0))
+            sent[chat_id] = (label, time.perf_counter())
+            async with http.post(url, json=upd, headers=headers) as resp:
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+        started = time.perf_counter()
+        tasks = []
+        for k, (label, upd) in enumerate(updates):
+            delay = started + k / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(post(label, upd)))
+        await asyncio.gather(*tasks)
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline and any(c not in fakes.replies for c in sent):
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+    per_label: Dict[str, List[float]] = {}
+    timeouts: Dict[str, int] = {}
+    for chat_id, (label, t0) in sent.items():
+        t1 = fakes.replies.get(chat_id)
+        if t1 is None:
+            timeouts[label] = timeouts.get(label, 0) + 1
+        else:
+            per_label.setdefault(label, []).append((t1 - t0) * 1000)
+    done = sum(len(v) for v in per_label.values())
+    return {
+        "phase": name,
+        "updates": len(sent),
+        "http_status": statuses,
+        "throughput": round(done / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            label: {"n": len(v), "p50": round(_pct(v, 0.50), 1), "p95": round(_pct(v, 0.95), 1),
+                    "p99": round(_pct(v, 0.99), 1), "timeouts": timeouts.get(label, 0)}
+            for label, v in sorted(per_label.items())
+        },
+        "timeouts": sum(timeouts.values()),
+        "calls": {k: v - calls_before.get(k, 0) for k, v in sorted(fakes.calls.items())
+                  if v != calls_before.get(k, 0)},
+        "rss_growth_mb": round(_rss_mb() - rss_before, 1),
+    }
+
+
+def _print_phase(r: Dict[str, Any]) -> None:
+    print(f"\n== {r['phase']}: {r['updates']} updates, {r['throughput']}/s, "
+          f"timeouts={r['timeouts']}, rss +{r['rss_growth_mb']} MB, http={r['http_status']}")
+    for label, s in r["latency_ms"].items():
+        print(f"   {label:<16} n={s['n']:<5} p50={s['p50']:>8} p95={s['p95']:>8} p99={s['p99']:>8} ms")
+    print(f"   calls: {r['calls']}")
+
+
+async def main(args: argparse.Namespace) -> int:
+    fake_port, bot_port = _free_port(), _free_port()
+    base = f"http://127.0.0.1:{fake_port}"
+    fakes = FakeServers(args.upstream_latency, args.error_rate, args.coins)
+    _serve_in_thread(fakes.app, fake_port)
+
+    os.environ.update({
+        "TELEGRAM_TOKEN": TOKEN, "SECRET_TOKEN": SECRET,
+        "WEBHOOK_BASE": f"http://127.0.0.1:{bot_port}",
+        "CRYPTO_API_KEY": f"{base}/crypto", "GOLD_API_KEY": f"{base}/gold",
+        "TELEGRAM_API_BASE": f"{base}/bot", "INGRESS": args.ingress,
+    })
+    if not args.real_limits:
+        os.environ.setdefault("TG_GLOBAL_RATE", "1000000")
+    if args.startup:
+        return run_startup(args.startup, args.max_startup_ms)
+    import_started = time.perf_counter()
+    import bot_13
+    import_ms = (time.perf_counter() - import_started) * 1000
+
+    if args.ingress == "aiohttp":
+        _serve_in_thread(bot_13.create_aiohttp_app, bot_port)
+    else:
+        from werkzeug.serving import make_server
+        server = make_server("127.0.0.1", bot_port, bot_13.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    deadline = time.perf_counter() + 30
+    while not bot_13._ready and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    if not bot_13._ready:
+        print("bot did not start", file=sys.stderr)
+        return 2
+    print(f"bot_13 imported in {import_ms:.0f} ms, ingress={args.ingress}")
+
+    url = f"http://127.0.0.1:{bot_port}/webhook"
+    results, uid = [], 1
+    if args.updates:
+        phases = [("replay", load_updates(args.updates, uid))]
+    else:
+        phases = []
+        for command in args.commands.split(","):
+            phases.append((command, synth_updates(command, args.count, uid)))
+            uid += args.count
+    for name, updates in phases:
+        r = await run_phase(name, updates, url, args.rate, fakes, args.timeout)
+        results.append(r)
+        _print_phase(r)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"import_ms": round(import_ms, 1), "phases": results}, f, indent=2)
+    if args.max_p95_ms:
+        worst = max((s["p95"] for r in results for s in r["latency_ms"].values()), default=0)
+        if worst > args.max_p95_ms or any(r["timeouts"] for r in results):
+            print(f"FAIL: worst p95 {worst} ms (limit {args.max_p95_ms}) or timeouts", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="Offline load test for bot_13.py")
+    p.add_argument("--commands", default=DEFAULT_COMMANDS,
+                   help="comma-separated phases; cb:<data> sends a callback query, inline:<text> an inline query")
+    p.add_argument("--updates", help="JSONL file of recorded webhook updates to replay")
+    p.add_argument("--count", type=int, default=200, help="updates per phase")
+    p.add_argument("--rate", type=float, default=50, help="updates per second")
+    p.add_argument("--timeout", type=float, default=15, help="seconds to wait for replies")
+    p.add_argument("--ingress", choices=("flask", "aiohttp"), default="flask")
+    p.add_argument("--upstream-latency", type=float, default=0.05, help="mean fake API latency (s)")
+    p.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream calls that fail")
+    p.add_argument("--coins", type=int, default=2000, help="assets in the fake crypto payload")
+    p.add_argument("--real-limits", action="store_true", help="keep Telegram's 30 msg/s global limit")
+    p.add_argument("--json", help="also write results to this file")
+    p.add_argument("--max-p95-ms", type=float, help="exit 1 if any p95 exceeds this or replies time out")
+    p.add_argument("--startup", type=int, metavar="RUNS", help="only measure cold start over RUNS fresh imports")
+    p.add_argument("--max-startup-ms", type=float, help="with --startup: exit 1 if median time-to-ready exceeds this")
+    sys.exit(asyncio.run(main(p.parse_args())))
@@ -1,25 +1,44 @@
 # bazarroz_bot.py
 
 import os
+import difflib
+import math
+import random
 import logging
 import asyncio
+import atexit
+import bisect
+import csv
+import json
+import mmap
+import sqlite3
+import struct
+import tempfile
 import threading
-from typing import Any, Dict, List, Optional
+import time
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from dotenv import load_dotenv
-from flask import Flask, request
+from flask import Flask, jsonify, request
 import aiohttp
-import pandas as pd
-import requests
+from aiohttp import web
 
 from telegram import Update
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineQueryResultArticle, InputTextMessageContent
 import logging
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     ApplicationBuilder,
+    BaseRateLimiter,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
+    InlineQueryHandler,
 )
 
 # --Env & logging 
@@ -46,7 +65,7 @@ if not WEBHOOK_BASE:
 if not CRYPTO_API or not GOLD_API:
     raise RuntimeError("Missing one or more API URLs in .env")
 
-TELEGRAM_API = f"https://api.telegram.org/bot{TOKEN}"
+TELEGRAM_API_BASE = (os.getenv("TELEGRAM_API_BASE") or "https://api.telegram.org/bot").strip()
 
 # ---------- Real API endpoints ----------
 BOT_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -54,424 +73,2533 @@ SECRET_TOKEN = os.getenv("SECRET_TOKEN")
 CRYPTO_API = os.getenv("CRYPTO_API_KEY")
 GOLD_API = os.getenv("GOLD_API_KEY")
 
+# ---------- Webhook ingress ----------
+INGRESS           = (os.getenv("INGRESS") or "flask").strip().lower()  # flask | aiohttp
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE") or 1000)  # pending updates before 429/503
+UPDATE_WORKERS    = int(os.getenv("UPDATE_WORKERS") or 32)       # updates processed at once (across chats)
+DRAIN_TIMEOUT     = float(os.getenv("DRAIN_TIMEOUT") or 20)      # seconds to finish queued updates on shutdown
+DEDUP_WINDOW      = float(os.getenv("DEDUP_WINDOW") or 300)     # seconds an update_id is remembered
+DEDUP_MAX         = int(os.getenv("DEDUP_MAX") or 20_000)       # update_ids remembered at most
+CALLBACK_COALESCE = float(os.getenv("CALLBACK_COALESCE") or 1.5)  # seconds identical taps merge
+if INGRESS not in ("flask", "aiohttp"):
+    raise RuntimeError("INGRESS must be 'flask' or 'aiohttp'")
+
+# ---------- Outbound Telegram rate limits ----------
+TG_GLOBAL_RATE  = float(os.getenv("TG_GLOBAL_RATE") or 30)      # messages/s across all chats
+TG_CHAT_RATE    = float(os.getenv("TG_CHAT_RATE") or 1)         # messages/s to one private chat
+TG_GROUP_RATE   = float(os.getenv("TG_GROUP_RATE") or 20 / 60)  # messages/s to one group
+TG_CHAT_BURST   = float(os.getenv("TG_CHAT_BURST") or 3)
+TG_MAX_RETRIES  = int(os.getenv("TG_MAX_RETRIES") or 3)         # RetryAfter retries per request
+
+# ---------- Multi-worker shared snapshots (empty SHARED_DIR = each worker on its own) ----------
+# e.g. SHARED_DIR=/dev/shm/bazarroz gunicorn -w 4 bot_13:application
+SHARED_DIR  = (os.getenv("SHARED_DIR") or "").strip()
+SHARED_POLL = float(os.getenv("SHARED_POLL") or 0.5)  # seconds between follower version checks
+
+# ---------- Snapshot cache ----------
+CACHE_TTL       = float(os.getenv("CACHE_TTL") or 30)         # seconds a snapshot is fresh
+CACHE_MAX_STALE = float(os.getenv("CACHE_MAX_STALE") or 300)  # extra seconds served while revalidating
+
+# ---------- Upstream HTTP pool ----------
+HTTP_POOL_LIMIT    = int(os.getenv("HTTP_POOL_LIMIT") or 100)
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST") or 20)
+HTTP_KEEPALIVE     = float(os.getenv("HTTP_KEEPALIVE") or 30)
+HTTP_DNS_TTL       = int(os.getenv("HTTP_DNS_TTL") or 300)
+
+# ---------- Upstream resilience ----------
+# A user waits at most UPSTREAM_BUDGET for a cold fetch; past that they get
+# the last good snapshot (labelled with its age) or an error.
+UPSTREAM_BUDGET          = float(os.getenv("UPSTREAM_BUDGET") or 5)           # seconds per fetch, retries included
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT") or 1.5)
+UPSTREAM_READ_TIMEOUT    = float(os.getenv("UPSTREAM_READ_TIMEOUT") or 3)
+UPSTREAM_HEDGE_DELAY     = float(os.getenv("UPSTREAM_HEDGE_DELAY") or 1)      # send a second request if the first is this slow
+UPSTREAM_RETRIES         = int(os.getenv("UPSTREAM_RETRIES") or 2)
+UPSTREAM_BACKOFF         = float(os.getenv("UPSTREAM_BACKOFF") or 0.2)        # first retry delay, doubled each time
+BREAKER_FAILURES         = int(os.getenv("BREAKER_FAILURES") or 5)            # consecutive failed fetches that open it
+BREAKER_RESET            = float(os.getenv("BREAKER_RESET") or 30)            # seconds open before one probe is let through
+STALE_LABEL_AGE          = float(os.getenv("STALE_LABEL_AGE") or 120)         # snapshots older than this show their age
+
+# ---------- Background poller (POLL_INTERVAL=0: only once an alert exists, every CACHE_TTL) ----------
+POLL_INTERVAL     = float(os.getenv("POLL_INTERVAL") or 0)
+POLL_JITTER       = float(os.getenv("POLL_JITTER") or 0.1)    # +/- fraction of the interval
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL") or 300)
+POLL_SLOW_SECS    = float(os.getenv("POLL_SLOW_SECS") or 5)   # a fetch slower than this backs off
+
+# ---------- /search ----------
+SEARCH_BUDGET      = float(os.getenv("SEARCH_BUDGET") or 3)   # seconds /search waits for a fresh snapshot
+SEARCH_PAGE_SIZE   = int(os.getenv("SEARCH_PAGE_SIZE") or 5)
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS") or 50)
+
+# ---------- Price history ----------
+# The ring keeps one snapshot per HISTORY_INTERVAL for HISTORY_RETENTION and is
+# sized for HISTORY_SYMBOLS coins a snapshot, about 36 bytes a row (~20 MB by
+# default). HISTORY_MAX_ROWS overrides the size.
+HISTORY_RETENTION = float(os.getenv("HISTORY_RETENTION") or 86400)      # seconds
+HISTORY_INTERVAL  = float(os.getenv("HISTORY_INTERVAL") or 300)         # min seconds between recorded snapshots
+HISTORY_SYMBOLS   = int(os.getenv("HISTORY_SYMBOLS") or 2000)           # coins per snapshot
+HISTORY_MAX_ROWS  = int(os.getenv("HISTORY_MAX_ROWS") or
+                        HISTORY_RETENTION / max(HISTORY_INTERVAL, CACHE_TTL) * HISTORY_SYMBOLS)
+HISTORY_DB        = (os.getenv("HISTORY_DB") or "").strip()             # optional SQLite spill file
+HISTORY_PRUNE     = float(os.getenv("HISTORY_PRUNE") or 600)            # seconds between spill-file prunes
+
+# ---------- Candles & rolling stats (/history) ----------
+# Memory is about 64 bytes * CANDLE_KEEP * len(CANDLE_RESOLUTIONS) per symbol.
+CANDLE_KEEP        = int(os.getenv("CANDLE_KEEP") or 48)  # candles kept per symbol and resolution
+CANDLE_SHOW        = int(os.getenv("CANDLE_SHOW") or 12)  # candles listed by /history
+CANDLE_RESOLUTIONS = {"1m": 60, "15m": 900, "1h": 3600, "1d": 86400}
+
+# ---------- Inline mode (@bot btc) ----------
+INLINE_MAX_RESULTS = int(os.getenv("INLINE_MAX_RESULTS") or 20)    # results per answer (Telegram allows 50)
+INLINE_CACHE_MAX   = int(os.getenv("INLINE_CACHE_MAX") or 4096)    # query prefixes whose answers are kept
+INLINE_MIN_CACHE   = int(os.getenv("INLINE_MIN_CACHE") or 5)       # cache_time floor when a snapshot is stale
+
+# ---------- Price alerts ----------
+ALERT_COOLDOWN     = float(os.getenv("ALERT_COOLDOWN") or 900)     # min seconds between repeats of one alert
+ALERT_HYSTERESIS   = float(os.getenv("ALERT_HYSTERESIS") or 0.005) # fraction the price must move back to re-arm
+ALERT_MAX_PER_CHAT = int(os.getenv("ALERT_MAX_PER_CHAT") or 20)
+
+# ---------- /excel_file export ----------
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS") or 2)
+EXPORT_FORMATS = ("xlsx", "csv", "parquet")
+
 
-# --State
-bot_data: List[Any] = []  # for /excel_file snapshots
 # --Helpers
-async def get_crypto_data() -> Optional[List[Dict[str, Any]]]:
+def _num(v: Any) -> float:
+    # Upstream prices arrive as numbers or strings like "1,234.5"; nan when absent.
+    if isinstance(v, (int, float)):
+        return float(v)
     try:
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(CRYPTO_API, timeout=20) as resp:
-                d = await resp.json()
-                return d.get("data") if d else None
-    except Exception as e:
-        log.error("get_crypto_data error: %s", e)
+        return float(str(v).replace(",", ""))
+    except ValueError:
+        return math.nan
+
+try:
+    import orjson
+    _json_loads = orjson.loads  # accepts bytes and memoryview without copying
+except ImportError:
+    def _json_loads(buf: Any) -> Any:
+        return json.loads(bytes(buf))
+
+# Heavy optional modules load on first use (or from _warm_imports after startup),
+# so importing this file stays fast on a cold start.
+np: Any = None
+
+def _numpy() -> Any:
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+def _warm_imports() -> None:
+    # Runs in a worker thread once the bot is serving.
+    started = time.perf_counter()
+    for name in ("numpy", "openpyxl"):
+        try:
+            __import__(name)
+        except ImportError:
+            pass
+    _numpy()
+    log.info("warmed optional imports in %.0f ms", (time.perf_counter() - started) * 1000)
+
+def _fmt_price(v: float) -> str:
+    return f"{v:,.0f}" if abs(v) >= 1000 else f"{v:.8g}"
+
+def _fmt_num(v: float) -> str:
+    # Display form of a parsed upstream number: grouped, no float noise, "" when absent.
+    if math.isnan(v):
+        return ""
+    if v.is_integer():
+        return f"{v:,.0f}"
+    return f"{v:,.8f}".rstrip("0").rstrip(".")
+
+# --Snapshot records
+# Upstream payloads are decoded once per fetch into these and the raw JSON is
+# dropped; numbers are parsed up front so handlers never re-parse strings.
+class Coin:
+    """One crypto row, reduced to the fields the bot shows or stores."""
+
+    __slots__ = ("title", "symbol", "p", "p_irr", "volume", "d", "dp",
+                 "high_24h", "high_7d", "volatility", "stamp")
+
+    def __init__(self, title: str, symbol: str, p: float, p_irr: float, volume: float,
+                 d: float, dp: float, high_24h: float, high_7d: float, volatility: float,
+                 stamp: str):
+        self.title = title
+        self.symbol = symbol
+        self.p = p
+        self.p_irr = p_irr
+        self.volume = volume
+        self.d = d
+        self.dp = dp
+        self.high_24h = high_24h
+        self.high_7d = high_7d
+        self.volatility = volatility
+        self.stamp = stamp  # upstream "datetime", kept as sent
+
+    @classmethod
+    def from_json(cls, c: Dict[str, Any]) -> "Coin":
+        cr = c.get("cr") or {}
+        return cls(
+            str(c.get("title") or ""), str(c.get("symbol") or ""),
+            _num(c.get("p")), _num(c.get("p_irr")), _num(c.get("volume")),
+            _num(c.get("d")), _num(c.get("dp")),
+            _num(cr.get("highest-24h-usd")), _num(cr.get("highest-7d-usd")),
+            _num(cr.get("volatility-usd")), str(c.get("datetime") or ""),
+        )
+
+class Quote:
+    """One gold/coin/currency price from the gold feed's "current" block."""
+
+    __slots__ = ("p", "t", "ts")
+
+    def __init__(self, p: float, t: str, ts: str):
+        self.p = p
+        self.t = t
+        self.ts = ts
+
+    @classmethod
+    def from_json(cls, blk: Dict[str, Any]) -> "Quote":
+        return cls(_num(blk.get("p")), str(blk.get("t") or blk.get("t-g") or ""),
+                   str(blk.get("ts") or ""))
+
+def _parse_crypto(buf: Any) -> Optional[List[Coin]]:
+    d = _json_loads(buf)
+    rows = d.get("data") if isinstance(d, dict) else None
+    if not isinstance(rows, list):
+        return None
+    return [Coin.from_json(c) for c in rows if isinstance(c, dict)]
+
+def _parse_gold(buf: Any) -> Optional[Dict[str, Quote]]:
+    d = _json_loads(buf)
+    current = d.get("current") if isinstance(d, dict) else None
+    if not isinstance(current, dict):
         return None
+    return {key: Quote.from_json(blk) for key, blk in current.items() if isinstance(blk, dict)}
+
+# --Metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+Labels = Tuple[Tuple[str, str], ...]
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, v)] += 1
+        self.sum += v
+        self.count += 1
+
+class _Metrics:
+    """Minimal Prometheus text-format registry.
+
+    Recording is a dict lookup plus a bisect, cheap enough for every update.
+    Gauges, and counters a component already keeps itself, are callables
+    evaluated only when /metrics is scraped.
+    """
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], _Histogram] = {}
+        self.gauges: Dict[str, Tuple[str, Any]] = {}  # name -> (type, fn)
+
+    def inc(self, name: str, labels: Labels = (), v: float = 1) -> None:
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + v
+
+    def observe(self, name: str, v: float, labels: Labels = ()) -> None:
+        key = (name, labels)
+        h = self.histograms.get(key)
+        if h is None:
+            h = self.histograms[key] = _Histogram()
+        h.observe(v)
+
+    def gauge(self, name: str, fn) -> None:
+        # fn() -> number, or a list of (labels, number)
+        self.gauges[name] = ("gauge", fn)
+
+    def counter(self, name: str, fn) -> None:
+        # like gauge(), for a running total that only ever goes up
+        self.gauges[name] = ("counter", fn)
 
-async def fetch_gold_data() -> Optional[Dict[str, Any]]:
+    @staticmethod
+    def _fmt(name: str, labels: Labels, extra: str = "") -> str:
+        parts = [f'{k}="{v}"' for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return f"{name}{{{','.join(parts)}}}" if parts else name
+
+    def render(self) -> str:
+        out: List[str] = []
+        typed = set()
+
+        def family(name: str, kind: str) -> None:
+            if name not in typed:
+                typed.add(name)
+                out.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), v in sorted(self.counters.items()):
+            family(name, "counter")
+            out.append(f"{self._fmt(name, labels)} {v}")
+        for (name, labels), h in sorted(self.histograms.items()):
+            family(name, "histogram")
+            cum = 0
+            for le, n in zip(LATENCY_BUCKETS + ("+Inf",), h.counts):
+                cum += n
+                bucket = self._fmt(name + "_bucket", labels, f'le="{le}"')
+                out.append(f"{bucket} {cum}")
+            out.append(f"{self._fmt(name + '_sum', labels)} {h.sum}")
+            out.append(f"{self._fmt(name + '_count', labels)} {h.count}")
+        for name, (kind, fn) in sorted(self.gauges.items()):
+            try:
+                value = fn()
+            except Exception:
+                continue
+            family(name, kind)
+            for labels, v in (value if isinstance(value, list) else [((), value)]):
+                out.append(f"{self._fmt(name, labels)} {v}")
+        return "\n".join(out) + "\n"
+
+metrics = _Metrics()
+
+def _timed(kind: str, name: str, fn):
+    # Wrap a PTB callback with latency and error accounting under bot_handler_*.
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        label = name
+        if kind == "callback" and update.callback_query:
+            label = (update.callback_query.data or "").split(":", 1)[0]
+            if label not in CALLBACK_LABELS:
+                label = "other"
+        labels = (("kind", kind), ("name", label))
+        started = time.perf_counter()
+        try:
+            return await fn(update, context)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", labels)
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, labels)
+    return wrapper
+
+async def _watch_loop_lag(interval: float = 0.5) -> None:
+    # How late the loop wakes us up is how long any update would have waited to start.
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = time.monotonic() - started - interval
+        metrics.observe("bot_event_loop_lag_seconds", lag)
+        _loop_lag[0] = lag
+
+_loop_lag = [0.0]
+
+_http: Optional[aiohttp.ClientSession] = None
+_pool_stats = {"requests": 0, "connections_created": 0, "connections_reused": 0}
+
+def _count(key: str):
+    async def on_event(session, ctx, params) -> None:
+        _pool_stats[key] += 1
+    return on_event
+
+def _http_session() -> aiohttp.ClientSession:
+    # One keep-alive pool for every upstream fetcher, created on the PTB loop.
+    global _http
+    if _http is None or _http.closed:
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(_count("requests"))
+        trace.on_connection_create_end.append(_count("connections_created"))
+        trace.on_connection_reuseconn.append(_count("connections_reused"))
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            ttl_dns_cache=HTTP_DNS_TTL,
+        )
+        _http = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+    return _http
+
+def pool_stats() -> Dict[str, Any]:
+    stats: Dict[str, Any] = dict(_pool_stats)
+    n = stats["connections_created"] + stats["connections_reused"]
+    stats["reuse_ratio"] = round(stats["connections_reused"] / n, 3) if n else 0.0
+    if _http is not None and not _http.closed:
+        conn = _http.connector
+        stats["limit"], stats["limit_per_host"] = conn.limit, conn.limit_per_host
+    return stats
+
+class _CircuitBreaker:
+    """Stops calling an upstream that keeps failing.
+
+    closed -> open after `failures` consecutive failed fetches; while open every
+    call is refused without touching the network. After `reset` seconds one
+    probe is let through (half_open): success closes it, failure re-opens it.
+    """
+
+    STATES = ("closed", "half_open", "open")
+
+    def __init__(self, name: str, failures: int, reset: float, clock=time.monotonic):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self._clock = clock
+        self.state = "closed"
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.opened = self.rejected = 0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == "open" and self._clock() - self.opened_at >= self.reset:
+            self.state = "half_open"
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self) -> None:
+        if self.state != "closed":
+            log.info("%s upstream recovered, breaker closed", self.name)
+        self.state = "closed"
+        self.consecutive = 0
+        self._probing = False
+
+    def abandon(self) -> None:
+        # The call was cancelled before it had an outcome; free the probe
+        # slot so a half-open breaker doesn't wait on it forever.
+        self._probing = False
+
+    def failure(self) -> None:
+        self.consecutive += 1
+        self._probing = False
+        if self.state == "half_open" or self.consecutive >= self.failures:
+            if self.state != "open":
+                self.opened += 1
+                log.warning("%s upstream failing, breaker open for %.0fs", self.name, self.reset)
+            self.state = "open"
+            self.opened_at = self._clock()
+
+    def info(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self.consecutive,
+                "opened": self.opened, "rejected": self.rejected}
+
+_breakers = {name: _CircuitBreaker(name, BREAKER_FAILURES, BREAKER_RESET) for name in ("crypto", "gold")}
+
+async def _get_body(url: str) -> bytes:
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=UPSTREAM_CONNECT_TIMEOUT,
+                                    sock_read=UPSTREAM_READ_TIMEOUT)
+    async with _http_session().get(url, timeout=timeout) as resp:
+        resp.raise_for_status()
+        return await resp.read()
+
+async def _hedged(name: str, url: str) -> bytes:
+    # If the first request hasn't answered after UPSTREAM_HEDGE_DELAY, race a
+    # second one against it; the first good answer wins, the other is cancelled.
+    pending = {asyncio.ensure_future(_get_body(url))}
+    error: Optional[BaseException] = None
     try:
-        async with aiohttp.ClientSession() as sess:
-            async with sess.get(GOLD_API, timeout=20) as resp:
-                return await resp.json()
-    except Exception as e:
-        log.error("fetch_gold_data error: %s", e)
+        done, pending = await asyncio.wait(pending, timeout=UPSTREAM_HEDGE_DELAY)
+        if not done:
+            metrics.inc("bot_upstream_hedges_total", (("feed", name),))
+            pending.add(asyncio.ensure_future(_get_body(url)))
+        while done or pending:
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+# Last good response body per feed, exactly as received; the snapshot leader
+# publishes these to the other workers instead of re-encoding the records.
+# Only the leader keeps them; nobody else would ever read them.
+_raw_bodies: Dict[str, bytes] = {}
+
+async def _fetch_upstream(name: str, url: str, parse) -> Any:
+    # Hedged request, retried with jittered exponential backoff, all inside
+    # UPSTREAM_BUDGET. A body that doesn't parse counts as a failure. None
+    # when the breaker is open or every attempt failed.
+    breaker = _breakers[name]
+    labels = (("feed", name),)
+    if not breaker.allow():
+        metrics.inc("bot_upstream_short_circuits_total", labels)
+        return None
+    try:
+        return await _attempt_upstream(name, url, parse, breaker, labels)
+    except asyncio.CancelledError:
+        breaker.abandon()
+        raise
+
+async def _attempt_upstream(name: str, url: str, parse, breaker: _CircuitBreaker,
+                            labels) -> Any:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + UPSTREAM_BUDGET
+    for attempt in range(UPSTREAM_RETRIES + 1):
+        try:
+            body = await asyncio.wait_for(_hedged(name, url), max(deadline - loop.time(), 0.01))
+            value = parse(body)
+            if value is None:
+                raise ValueError("unexpected payload shape")
+            breaker.success()
+            if _role == "leader":
+                _raw_bodies[name] = body
+            return value
+        except Exception as e:
+            log.warning("%s fetch attempt %d failed: %r", name, attempt + 1, e)
+        delay = UPSTREAM_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+        if attempt == UPSTREAM_RETRIES or loop.time() + delay >= deadline:
+            break
+        metrics.inc("bot_upstream_retries_total", labels)
+        await asyncio.sleep(delay)
+    breaker.failure()
+    log.error("%s fetch failed", name)
+    return None
+
+def upstream_info() -> Dict[str, Any]:
+    return {name: b.info() for name, b in _breakers.items()}
+
+async def _download_crypto() -> Optional[List[Coin]]:
+    return await _fetch_upstream("crypto", CRYPTO_API, _parse_crypto)
+
+async def _download_gold() -> Optional[Dict[str, Quote]]:
+    return await _fetch_upstream("gold", GOLD_API, _parse_gold)
+
+class _SnapshotCache:
+    """Last upstream payload, shared by every handler.
+
+    Fresh for `ttl` seconds; for `max_stale` seconds after that the old value is
+    returned immediately while one background refresh runs. Concurrent misses
+    await the same in-flight fetch instead of each hitting the API.
+    """
+
+    def __init__(self, name: str, fetch, ttl: float, max_stale: float):
+        self.name = name
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.value: Any = None
+        self.fetched_at = 0.0
+        self.version = 0
+        self.hits = self.stale_hits = self.misses = self.fallbacks = 0
+        self._fetch = fetch
+        self._inflight: Optional[asyncio.Task] = None
+        self._listeners: List[Any] = []
+
+    def subscribe(self, fn) -> None:
+        # fn(value, version) runs on the PTB loop after every successful refresh
+        self._listeners.append(fn)
+
+    def age(self) -> float:
+        if self.value is None:
+            return float("inf")
+        return time.monotonic() - self.fetched_at
+
+    async def get(self) -> Any:
+        age = self.age()
+        if age < self.ttl:
+            self.hits += 1
+            return self.value
+        if age < self.ttl + self.max_stale:
+            self.stale_hits += 1
+            self.refresh()
+            return self.value
+        self.misses += 1
+        # shield: a cancelled handler must not cancel the fetch other callers share
+        value = await asyncio.shield(self.refresh())
+        if value is None and self.value is not None:
+            # upstream is down: the last good snapshot beats an error
+            self.fallbacks += 1
+            return self.value
+        return value
+
+    def refresh(self) -> asyncio.Task:
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.ensure_future(self._run())
+        return self._inflight
+
+    async def _run(self) -> Any:
+        started = time.perf_counter()
+        value = await self._fetch()
+        labels = (("feed", self.name),)
+        metrics.observe("bot_upstream_seconds", time.perf_counter() - started, labels)
+        if value is None:
+            metrics.inc("bot_upstream_errors_total", labels)
+        else:
+            self.store(value)
+        return value
+
+    def store(self, value: Any) -> None:
+        self.value = value
+        self.fetched_at = time.monotonic()
+        self.version += 1
+        for fn in self._listeners:
+            try:
+                fn(value, self.version)
+            except Exception:
+                log.exception("%s snapshot listener failed", self.name)
+
+    def info(self) -> Dict[str, Any]:
+        age = self.age()
+        return {
+            "version": self.version,
+            "age": None if age == float("inf") else round(age, 1),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "fallbacks": self.fallbacks,
+        }
+
+_crypto_cache = _SnapshotCache("crypto", _download_crypto, CACHE_TTL, CACHE_MAX_STALE)
+_gold_cache   = _SnapshotCache("gold", _download_gold, CACHE_TTL, CACHE_MAX_STALE)
+
+async def _poll(cache: _SnapshotCache, base: float = POLL_INTERVAL) -> None:
+    # Keep the snapshot hot so handlers never wait on the upstream. Slow or
+    # failed fetches double the interval (up to POLL_MAX_INTERVAL); a healthy
+    # fetch drops it back to `base`.
+    cache.max_stale = max(cache.max_stale, 2 * POLL_MAX_INTERVAL)
+    interval = base
+    while True:
+        started = time.monotonic()
+        ok = await cache.refresh() is not None
+        elapsed = time.monotonic() - started
+        if ok and elapsed < POLL_SLOW_SECS:
+            interval = base
+        else:
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
+            log.warning("%s poll %s in %.1fs, next in %.0fs",
+                        cache.name, "ok" if ok else "failed", elapsed, interval)
+        jitter = interval * POLL_JITTER * random.uniform(-1, 1)
+        await asyncio.sleep(max(interval + jitter - elapsed, 0.5))
+
+def _age_note(cache: _SnapshotCache) -> str:
+    # Appended to replies built from a snapshot the upstream hasn't refreshed lately.
+    age = cache.age()
+    if age < STALE_LABEL_AGE or age == float("inf"):
+        return ""
+    if age < 3600:
+        ago = f"{int(age // 60)} min"
+    else:
+        ago = f"{age / 3600:.1f} h"
+    return f"\n\n⏱ Price source unavailable – data from {ago} ago."
+
+def snapshot_info() -> Dict[str, Any]:
+    return {c.name: c.info() for c in (_crypto_cache, _gold_cache)}
+
+# --Shared snapshots (multi-worker)
+_SNAP_HEADER = struct.Struct("<4sQQd")  # magic, seq, payload length, published_at
+_SNAP_MAGIC = b"BZS1"
+
+class _SharedSnapshot:
+    """One feed's latest payload in a memory-mapped file under SHARED_DIR.
+
+    The leader writes, every other worker maps the same file and reads. A
+    seqlock guards the header: `seq` is odd while a write is in progress, and
+    a reader retries if it changed under it. `seq // 2` is the version.
+    """
+
+    def __init__(self, path: str, parse):
+        self.path = path
+        self.parse = parse  # bytes -> records, the same parser the upstream fetch uses
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._mm: Optional[mmap.mmap] = None
+        self._size = 0
+        self.seen = 0
+
+    def _remap(self) -> bool:
+        size = os.fstat(self._fd).st_size
+        if size < _SNAP_HEADER.size:
+            return False
+        if size != self._size:
+            if self._mm is not None:
+                self._mm.close()
+            self._mm = mmap.mmap(self._fd, size)
+            self._size = size
+        return True
+
+    def _seq(self) -> int:
+        magic, seq, _, _ = _SNAP_HEADER.unpack_from(self._mm, 0)
+        return seq if magic == _SNAP_MAGIC else 0
+
+    def publish(self, payload: bytes) -> None:
+        need = _SNAP_HEADER.size + len(payload)
+        self._remap()
+        if self._size < need:
+            # grow with headroom, never shrink (a reader's mapping must stay valid);
+            # readers notice the new size and remap
+            os.ftruncate(self._fd, max(need + need // 2, 1 << 20))
+            self._remap()
+        mm = self._mm
+        seq = self._seq()
+        seq += seq & 1  # a leader that died mid-write left it odd
+        _SNAP_HEADER.pack_into(mm, 0, _SNAP_MAGIC, seq + 1, 0, 0.0)
+        mm[_SNAP_HEADER.size:need] = payload
+        _SNAP_HEADER.pack_into(mm, 0, _SNAP_MAGIC, seq + 2, len(payload), time.time())
+        self.seen = seq + 2
+
+    def version(self) -> int:
+        return self._seq() // 2 if self._remap() else 0
+
+    def read(self) -> Any:
+        # Decodes straight out of the mapping. None while nothing is published
+        # or a write is in progress; never waits, since it runs on the PTB loop.
+        if not self._remap():
+            return None
+        magic, seq, n, _ = _SNAP_HEADER.unpack_from(self._mm, 0)
+        if magic != _SNAP_MAGIC or not seq or seq & 1:
+            return None
+        try:
+            with memoryview(self._mm) as mv:
+                value = self.parse(mv[_SNAP_HEADER.size:_SNAP_HEADER.size + n])
+        except (ValueError, TypeError, AttributeError):
+            return None  # torn read; the caller tries again later
+        if self._seq() != seq:
+            return None
+        self.seen = seq
+        return value
+
+    async def fetch(self) -> Any:
+        # A cold follower cache: give an in-progress write a few ms to finish.
+        for _ in range(20):
+            value = self.read()
+            if value is not None:
+                return value
+            await asyncio.sleep(0.005)
         return None
 
-async def top_crypto_text(data: List[Dict[str, Any]]) -> str:
+_role = "single"      # single | leader | follower
+_leader_fd: Optional[int] = None
+_shared: Dict[str, _SharedSnapshot] = {}
+_upstream_fetch = {"crypto": _download_crypto, "gold": _download_gold}
+
+def _try_lead() -> bool:
+    global _leader_fd
+    import fcntl
+    fd = os.open(os.path.join(SHARED_DIR, "leader.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    _leader_fd = fd  # held (never closed) for the life of the process
+    return True
+
+def _become_leader() -> None:
+    global _role
+    _role = "leader"
+    price_history.spill_writes = True
+    for cache in (_crypto_cache, _gold_cache):
+        cache._fetch = _upstream_fetch[cache.name]
+        cache.ttl = CACHE_TTL
+        shared = _shared[cache.name]
+        cache.subscribe(lambda value, version, shared=shared, name=cache.name:
+                        shared.publish(_raw_bodies[name]))
+        # followers depend on us, so the leader always polls
+        _bg_tasks.append(asyncio.ensure_future(_poll(cache, POLL_INTERVAL or CACHE_TTL)))
+    _bg_tasks.append(asyncio.ensure_future(_sync_alerts()))  # alerts fire from the leader only
+    log.info("worker %s is the snapshot leader", os.getpid())
+
+async def _follow() -> None:
+    # Adopt each new shared version; take over if the leader's lock frees up.
+    global _role
+    _role = "follower"
+    price_history.spill_writes = False  # the leader writes HISTORY_DB for everyone
+    for cache in (_crypto_cache, _gold_cache):
+        cache._fetch = _shared[cache.name].fetch
+        cache.ttl = math.inf  # freshness is the leader's job
+    ticks = 0
+    while True:
+        for cache in (_crypto_cache, _gold_cache):
+            shared = _shared[cache.name]
+            if shared.version() * 2 != shared.seen:
+                value = shared.read()
+                if value is not None:
+                    cache.store(value)
+        ticks += 1
+        if ticks % 10 == 0 and _try_lead():
+            _become_leader()
+            return
+        await asyncio.sleep(SHARED_POLL)
+
+async def _start_feeds() -> bool:
+    # Returns True when this process should also run the one-time startup tasks.
+    if not SHARED_DIR:
+        if POLL_INTERVAL > 0:
+            _bg_tasks.extend(asyncio.ensure_future(_poll(c)) for c in (_crypto_cache, _gold_cache))
+        return True
+    global _alert_store
+    os.makedirs(SHARED_DIR, exist_ok=True)
+    _alert_store = _AlertStore(os.path.join(SHARED_DIR, "alerts.db"))
+    _dedup.shared = _SharedUpdateIds(os.path.join(SHARED_DIR, "update_ids"), DEDUP_MAX)
+    for name, parse in (("crypto", _parse_crypto), ("gold", _parse_gold)):
+        _shared[name] = _SharedSnapshot(os.path.join(SHARED_DIR, f"{name}.snap"), parse)
+    if _try_lead():
+        _become_leader()
+        return True
+    _bg_tasks.append(asyncio.ensure_future(_follow()))
+    return False
+
+def shared_info() -> Dict[str, Any]:
+    return {"role": _role, "pid": os.getpid(),
+            "versions": {name: s.version() for name, s in _shared.items()}}
+
+async def get_crypto_data() -> Optional[List[Coin]]:
+    return await _crypto_cache.get()
+
+async def fetch_gold_data() -> Optional[Dict[str, Quote]]:
+    return await _gold_cache.get()
+
+# --Search index
+def _title_words(text: str) -> str:
+    return " ".join(text.upper().replace("-", " ").split())
+
+class _SymbolIndex:
+    """Lookup tables for one crypto snapshot, built once when it arrives.
+
+    Matches rank as: exact symbol, symbol prefix, title/word prefix, then
+    fuzzy (difflib) matches over symbols for typos. Titles and queries treat
+    "-" as a space, so "bitcoin cash" and "bitcoin-cash" both find BCH.
+    """
+
+    def __init__(self, coins: List[Coin], version: int):
+        self.version = version
+        self.coins = coins
+        self.exact: Dict[str, List[int]] = {}
+        self.symbol_trie: Dict[str, Any] = {}
+        self.title_trie: Dict[str, Any] = {}
+        for i, c in enumerate(coins):
+            sym = c.symbol.upper()
+            if sym:
+                self.exact.setdefault(sym, []).append(i)
+                self._insert(self.symbol_trie, sym, i)
+            title = _title_words(c.title)
+            for word in {title, *title.split()}:
+                if word:
+                    self._insert(self.title_trie, word, i)
+        self.symbols = list(self.exact)
+
+    @staticmethod
+    def _insert(trie: Dict[str, Any], word: str, i: int) -> None:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node.setdefault("", []).append(i)
+
+    @staticmethod
+    def _prefixed(trie: Dict[str, Any], prefix: str, limit: int) -> List[int]:
+        node = trie
+        for ch in prefix:
+            node = node.get(ch)
+            if node is None:
+                return []
+        # breadth-first, so shorter completions rank first ("BT" -> BTC before BTCST)
+        out: List[int] = []
+        queue = deque([node])
+        while queue and len(out) < limit:
+            node = queue.popleft()
+            out.extend(node.get("", ()))
+            queue.extend(node[k] for k in sorted(node) if k)
+        return out
+
+    def lookup(self, query: str, limit: int = SEARCH_MAX_RESULTS) -> List[Coin]:
+        q = query.strip().upper()
+        if not q:
+            return []
+        ids: List[int] = list(self.exact.get(q, ()))
+        ids += self._prefixed(self.symbol_trie, q, limit)
+        ids += self._prefixed(self.title_trie, _title_words(q), limit)
+        if not ids:
+            for sym in difflib.get_close_matches(q, self.symbols, n=limit, cutoff=0.6):
+                ids += self.exact[sym]
+        seen, out = set(), []
+        for i in ids:
+            if i not in seen:
+                seen.add(i)
+                out.append(self.coins[i])
+                if len(out) >= limit:
+                    break
+        return out
+
+_search_index: Optional[_SymbolIndex] = None
+
+def _rebuild_search_index(coins: List[Coin], version: int) -> None:
+    global _search_index
+    _search_index = _SymbolIndex(coins, version)
+
+_crypto_cache.subscribe(_rebuild_search_index)
+
+# --Price history
+HistoryRow = Tuple[float, str, float, float, float]  # ts, symbol, price, price_irr, volume
+
+class _PriceHistory:
+    """Crypto price observations in a fixed-size ring of typed columns.
+
+    Snapshots whose upstream timestamp has not moved are skipped, and so is
+    any snapshot within `interval` seconds of the last one recorded. Rows
+    older than `retention` seconds are ignored and eventually overwritten;
+    span() says how far back the ring really reaches. With a
+    `db_path` every row is also appended to SQLite by a dedicated writer
+    thread (pruned to the same retention every HISTORY_PRUNE seconds), and
+    reads come from there so history survives restarts.
+    Only one process may write the file: followers of a shared snapshot
+    clear `spill_writes` and just read it.
+    """
+
+    def __init__(self, max_rows: int, retention: float, db_path: str = "", interval: float = 0.0):
+        self.max_rows = max_rows
+        self.retention = retention
+        self.interval = interval
+        self.ts        = array("d", bytes(8 * max_rows))
+        self.sym       = array("I", bytes(4 * max_rows))
+        self.price     = array("d", bytes(8 * max_rows))
+        self.price_irr = array("d", bytes(8 * max_rows))
+        self.volume    = array("d", bytes(8 * max_rows))
+        self.head = self.size = 0
+        self.symbols: List[str] = []
+        self._sym_ids: Dict[str, int] = {}
+        self.last_key: Any = None
+        self.last_ts = -math.inf
+        self.skipped = self.throttled = 0
+        self.db_path = db_path
+        self.spill_writes = True
+        self._db: Optional[sqlite3.Connection] = None  # writer thread only
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._pruned = 0.0
+        if db_path:
+            db = sqlite3.connect(db_path)
+            try:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS history "
+                    "(ts REAL, symbol TEXT, price REAL, price_irr REAL, volume REAL)"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS history_ts ON history (ts)")
+                db.commit()
+            finally:
+                db.close()
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-db")
+
+    def __len__(self) -> int:
+        return self.size
+
+    def symbol_id(self, symbol: str) -> int:
+        sid = self._sym_ids.get(symbol)
+        if sid is None:
+            sid = self._sym_ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return sid
+
+    @staticmethod
+    def snapshot_key(coins: List[Coin]) -> Any:
+        stamp = max((c.stamp for c in coins), default="")
+        return stamp or hash(tuple((c.symbol, c.p) for c in coins))
+
+    def add_snapshot(self, coins: List[Coin], now: Optional[float] = None) -> bool:
+        key = self.snapshot_key(coins)
+        if key == self.last_key:
+            self.skipped += 1
+            return False
+        now = time.time() if now is None else now
+        if now - self.last_ts < self.interval:
+            self.throttled += 1
+            return False
+        self.last_key = key
+        self.last_ts = now
+        spill = []
+        for c in coins:
+            symbol = c.symbol
+            if not symbol:
+                continue
+            i = self.head
+            self.ts[i] = now
+            self.sym[i] = self.symbol_id(symbol)
+            self.price[i] = c.p
+            self.price_irr[i] = c.p_irr
+            self.volume[i] = c.volume
+            self.head = (i + 1) % self.max_rows
+            self.size = min(self.size + 1, self.max_rows)
+            if self._writer is not None and self.spill_writes:
+                spill.append((now, symbol, self.price[i], self.price_irr[i], self.volume[i]))
+        if spill:
+            # disk I/O stays off the loop; one thread keeps the inserts in order
+            self._writer.submit(self._spill, spill)
+        return True
+
+    def _spill(self, rows: List[HistoryRow]) -> None:
+        try:
+            if self._db is None:
+                self._db = sqlite3.connect(self.db_path, timeout=10)
+            self._db.executemany("INSERT INTO history VALUES (?, ?, ?, ?, ?)", rows)
+            now = time.time()
+            if now - self._pruned >= HISTORY_PRUNE:
+                self._db.execute("DELETE FROM history WHERE ts < ?", (now - self.retention,))
+                self._pruned = now
+            self._db.commit()
+        except Exception:
+            log.exception("history spill of %d rows failed", len(rows))
+
+    def frozen(self) -> "_PriceHistory":
+        # Point-in-time copy of the ring for readers on other threads (a few
+        # memcpys); the SQLite-backed history is already safe to read there.
+        if self.db_path:
+            return self
+        copy = object.__new__(_PriceHistory)
+        copy.__dict__.update(self.__dict__)
+        for col in ("ts", "sym", "price", "price_irr", "volume"):
+            setattr(copy, col, getattr(self, col)[:])
+        copy.symbols = list(self.symbols)
+        return copy
+
+    def rows(self, since: Optional[float] = None, until: Optional[float] = None,
+             symbols: Optional[Iterable[str]] = None) -> Iterator[HistoryRow]:
+        # Oldest first. From a worker thread, call it on frozen().
+        since = max(since or 0.0, time.time() - self.retention)
+        until = math.inf if until is None else until
+        wanted = {s.upper() for s in symbols} if symbols else None
+        if self.db_path:
+            db = sqlite3.connect(self.db_path)
+            try:
+                cur = db.execute(
+                    "SELECT ts, symbol, price, price_irr, volume FROM history "
+                    "WHERE ts >= ? AND ts <= ? ORDER BY ts", (since, until)
+                )
+                for row in cur:
+                    if wanted is None or row[1].upper() in wanted:
+                        yield row
+            finally:
+                db.close()
+            return
+        start = (self.head - self.size) % self.max_rows
+        for k in range(self.size):
+            i = (start + k) % self.max_rows
+            ts = self.ts[i]
+            if ts < since or ts > until:
+                continue
+            symbol = self.symbols[self.sym[i]]
+            if wanted is None or symbol.upper() in wanted:
+                yield ts, symbol, self.price[i], self.price_irr[i], self.volume[i]
+
+    def span(self, now: Optional[float] = None) -> float:
+        # Seconds back the ring's oldest row reaches, at most `retention`.
+        if not self.size:
+            return 0.0
+        now = time.time() if now is None else now
+        oldest = self.ts[(self.head - self.size) % self.max_rows]
+        return max(min(now - oldest, self.retention), 0.0)
+
+    def info(self) -> Dict[str, Any]:
+        return {"rows": self.size, "max_rows": self.max_rows, "symbols": len(self.symbols),
+                "span": round(self.span()), "retention": self.retention, "interval": self.interval,
+                "skipped_snapshots": self.skipped, "throttled_snapshots": self.throttled,
+                "spill": bool(self.db_path)}
+
+price_history = _PriceHistory(HISTORY_MAX_ROWS, HISTORY_RETENTION, HISTORY_DB, HISTORY_INTERVAL)
+_crypto_cache.subscribe(lambda coins, version: price_history.add_snapshot(coins))
+
+# --Candles & rolling stats
+class _Candles:
+    """OHLC candles of one width for every series, in fixed per-series rings.
+
+    Series `sid` owns slots [sid * keep, (sid + 1) * keep) and bucket b lives
+    in slot b % keep, so each observation touches exactly one slot. Besides
+    OHLC a slot keeps the observation count and sum, plus the count, sum and
+    sum of squares of log returns, so any run of candles merges into a mean
+    and a volatility without the raw prices.
+    """
+
+    def __init__(self, width: int, keep: int):
+        self.width = width
+        self.keep = keep
+        self.bucket = array("q")
+        self.n      = array("I")
+        self.rn     = array("I")
+        self.open   = array("d")
+        self.high   = array("d")
+        self.low    = array("d")
+        self.close  = array("d")
+        self.total  = array("d")
+        self.rsum   = array("d")
+        self.rsq    = array("d")
+
+    def grow(self) -> None:
+        # room for one more series
+        k = self.keep
+        self.bucket.extend(array("q", [-1]) * k)
+        for col in (self.n, self.rn):
+            col.frombytes(bytes(4 * k))
+        for col in (self.open, self.high, self.low, self.close, self.total, self.rsum, self.rsq):
+            col.frombytes(bytes(8 * k))
+
+    def update(self, sid: int, ts: float, price: float, ret: Optional[float]) -> None:
+        b = int(ts // self.width)
+        i = sid * self.keep + b % self.keep
+        if self.bucket[i] != b:
+            self.bucket[i] = b
+            self.open[i] = self.high[i] = self.low[i] = price
+            self.n[i] = self.rn[i] = 0
+            self.total[i] = self.rsum[i] = self.rsq[i] = 0.0
+        elif price > self.high[i]:
+            self.high[i] = price
+        elif price < self.low[i]:
+            self.low[i] = price
+        self.close[i] = price
+        self.n[i] += 1
+        self.total[i] += price
+        if ret is not None:
+            self.rn[i] += 1
+            self.rsum[i] += ret
+            self.rsq[i] += ret * ret
+
+    def slots(self, sid: int, now: float) -> List[int]:
+        # Slots of the candles still inside the window, oldest first.
+        cur = int(now // self.width)
+        base = sid * self.keep
+        return [base + b % self.keep for b in range(cur - self.keep + 1, cur + 1)
+                if self.bucket[base + b % self.keep] == b]
+
+    def nbytes(self) -> int:
+        cols = (self.bucket, self.n, self.rn, self.open, self.high, self.low,
+                self.close, self.total, self.rsum, self.rsq)
+        return sum(len(c) * c.itemsize for c in cols)
+
+class _Aggregator:
+    """Candles at every CANDLE_RESOLUTIONS width for each crypto symbol and gold key.
+
+    Fed by the snapshot subscribers; a snapshot whose key matches the previous
+    one from the same feed is ignored so polling an idle upstream doesn't
+    skew counts or flatten volatility.
+    """
+
+    def __init__(self, keep: int, resolutions: Dict[str, int]):
+        self.series: Dict[str, int] = {}
+        self.last = array("d")  # latest price per series, for log returns
+        self.res = {name: _Candles(width, keep) for name, width in resolutions.items()}
+        self._keys: Dict[str, Any] = {}
+        self.skipped = 0
+
+    def _sid(self, name: str) -> int:
+        sid = self.series.get(name)
+        if sid is None:
+            sid = self.series[name] = len(self.last)
+            self.last.append(0.0)
+            for c in self.res.values():
+                c.grow()
+        return sid
+
+    def observe(self, feed: str, key: Any, items: Iterable[Tuple[str, float]],
+                now: Optional[float] = None) -> bool:
+        if key == self._keys.get(feed):
+            self.skipped += 1
+            return False
+        self._keys[feed] = key
+        now = time.time() if now is None else now
+        for name, price in items:
+            if not price > 0:  # also drops nan
+                continue
+            sid = self._sid(name)
+            prev = self.last[sid]
+            ret = math.log(price / prev) if prev > 0 else None
+            self.last[sid] = price
+            for c in self.res.values():
+                c.update(sid, now, price, ret)
+        return True
+
+    def lookup(self, sym: str) -> Optional[str]:
+        # crypto series are upper-case symbols, gold ones lower-case keys
+        for name in (sym.upper(), sym.lower(), sym):
+            if name in self.series:
+                return name
+        return None
+
+    def summary(self, name: str, res: str, now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        c = self.res[res]
+        slots = c.slots(self.series[name], time.time() if now is None else now)
+        if not slots:
+            return None
+        n = sum(c.n[i] for i in slots)
+        rn = sum(c.rn[i] for i in slots)
+        rmean = sum(c.rsum[i] for i in slots) / rn if rn else 0.0
+        var = sum(c.rsq[i] for i in slots) / rn - rmean * rmean if rn > 1 else math.nan
+        first, last = c.open[slots[0]], c.close[slots[-1]]
+        return {
+            "candles": [(c.bucket[i] * c.width, c.open[i], c.high[i], c.low[i], c.close[i])
+                        for i in slots],
+            "min": min(c.low[i] for i in slots),
+            "max": max(c.high[i] for i in slots),
+            "mean": sum(c.total[i] for i in slots) / n,
+            "change": (last / first - 1) * 100,
+            "volatility": math.sqrt(max(var, 0.0)) * 100 if rn > 1 else math.nan,
+            "observations": n,
+        }
+
+    def info(self) -> Dict[str, Any]:
+        return {"series": len(self.series), "skipped_snapshots": self.skipped,
+                "bytes": sum(c.nbytes() for c in self.res.values()) + len(self.last) * 8}
+
+candles = _Aggregator(CANDLE_KEEP, CANDLE_RESOLUTIONS)
+_crypto_cache.subscribe(lambda coins, version: candles.observe(
+    "crypto", _PriceHistory.snapshot_key(coins), ((c.symbol.upper(), c.p) for c in coins if c.symbol)))
+_gold_cache.subscribe(lambda d, version: candles.observe(
+    "gold", hash(tuple((k, q.ts, q.p) for k, q in d.items())), ((k.lower(), q.p) for k, q in d.items())))
+
+def _history_text(name: str, res: str) -> str:
+    s = candles.summary(name, res)
+    if s is None:
+        return f"No {res} candles for {name} yet."
+    width = CANDLE_RESOLUTIONS[res]
+    fmt = "%m-%d" if width >= 86400 else "%m-%d %H:%M"
+    span = f"{len(s['candles'])} x {res}"
+    vol = "" if math.isnan(s["volatility"]) else f" · volatility {s['volatility']:.2f}%"
+    lines = [
+        f"📈 {name} · {span} (UTC)",
+        f"min {_fmt_price(s['min'])} · max {_fmt_price(s['max'])} · mean {_fmt_price(s['mean'])}",
+        f"change {s['change']:+.2f}%{vol}",
+        "***********************************",
+    ]
+    for start, o, h, l, c in s["candles"][-CANDLE_SHOW:]:
+        stamp = time.strftime(fmt, time.gmtime(start))
+        lines.append(f"{stamp}  O {_fmt_price(o)}  H {_fmt_price(h)}  L {_fmt_price(l)}  C {_fmt_price(c)}")
+    return "\n".join(lines)
+
+async def top_crypto_text(data: List[Coin]) -> str:
     lines, last_dt = [], None
     for i, c in enumerate(data[:25]):
         lines += [
-            f"{i+1}💰 {c.get('title','')}",
-            f"({c.get('symbol','')})💲: {c.get('p','')} - IR{c.get('p_irr','')}",
-            f"volume📊: {c.get('volume','')}",
+            f"{i+1}💰 {c.title}",
+            f"({c.symbol})💲: {_fmt_num(c.p)} - IR{_fmt_num(c.p_irr)}",
+            f"volume📊: {_fmt_num(c.volume)}",
             "***********************************",
         ]
-        last_dt = c.get("datetime", last_dt)
+        last_dt = c.stamp or last_dt
     if last_dt:
         lines.append(f"⏲️ {last_dt}")
     return "\n".join(lines) if lines else "No crypto data to show."
 
 # --Command handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [[InlineKeyboardButton("🔍 Test Inline", callback_data="test")]]
-    markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("🧪 Inline button test:", reply_markup=markup)
+    await update.effective_message.reply_text(MENU_TEXT, reply_markup=MENU_MARKUP)
 
 
-async def top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def _render_top() -> str:
     data = await get_crypto_data()
-    if data:
-        bot_data.append(data)
-        await update.message.reply_text(await top_crypto_text(data))
-    else:
-        await update.message.reply_text("Failed to retrieve data.")
+    if not data:
+        return "Failed to retrieve data."
+    return await top_crypto_text(data) + _age_note(_crypto_cache)
+
+async def top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.effective_message.reply_text(await _render_top())
+
+def _coin_lines(c: Coin) -> List[str]:
+    return [
+        f"⏲️ {c.stamp}",
+        f"💰 {c.title} {c.symbol}",
+        f"💲{_fmt_num(c.p)}\nIR: {_fmt_num(c.p_irr)}",
+        f"change: {_fmt_num(c.d)}",
+        f"change%: {_fmt_num(c.dp)}",
+        f"highest-24h: {_fmt_num(c.high_24h)}",
+        f"highest-7d: {_fmt_num(c.high_7d)}",
+        f"volume📊: {_fmt_num(c.volume)}",
+        f"volatility: {_fmt_num(c.volatility)}",
+        "***********************************",
+    ]
+
+async def _render_search(query: str, page: int = 1) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    # /search has its own latency budget: past SEARCH_BUDGET we answer from
+    # whatever snapshot is already indexed rather than keep the user waiting.
+    try:
+        await asyncio.wait_for(asyncio.shield(get_crypto_data()), SEARCH_BUDGET)
+    except asyncio.TimeoutError:
+        log.warning("search budget exceeded, answering from last snapshot")
+    index = _search_index
+    if index is None:
+        return "Failed to retrieve data.", None
+    found = index.lookup(query)
+    if not found:
+        return f'"{query}" not found.', None
+    pages = (len(found) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    page = min(max(page, 1), pages)
+    lines: List[str] = []
+    for c in found[(page - 1) * SEARCH_PAGE_SIZE : page * SEARCH_PAGE_SIZE]:
+        lines += _coin_lines(c)
+    markup = None
+    if pages > 1:
+        lines.append(f"📄 {page}/{pages}")
+        nav = [
+            InlineKeyboardButton(label, callback_data=f"search:{p}:{query}")
+            for label, p in (("◀️", page - 1), ("▶️", page + 1)) if 1 <= p <= pages
+        ]
+        # callback_data is capped at 64 bytes; very long queries just lose paging
+        if all(len(b.callback_data.encode()) <= 64 for b in nav):
+            markup = InlineKeyboardMarkup([nav])
+    return "\n".join(lines) + _age_note(_crypto_cache), markup
+
+async def _search_page(message, query: str, page: int = 1) -> None:
+    text, markup = await _render_search(query, page)
+    await message.reply_text(text, reply_markup=markup)
 
 async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    data = await get_crypto_data()
-    symbol = "-".join(context.args) if context.args else ""
+    args = list(context.args or [])
+    page = 1
+    if len(args) > 1 and args[-1].isdigit():
+        page = int(args.pop())
+    symbol = " ".join(args)
     if not symbol:
-        return await update.message.reply_text("example... /search BTC")
-    if not data:
-        return await update.message.reply_text("Failed to retrieve data.")
-    filtered = [c for c in data if symbol.upper() in c.get("symbol","")]
-    if not filtered:
-        return await update.message.reply_text(f'"{symbol}" not found.')
-    lines = []
-    for c in filtered:
-        cr = c.get("cr", {})
-        lines += [
-            f"⏲️ {c.get('datetime','')}",
-            f"💰 {c.get('title','')} {c.get('symbol','')}",
-            f"💲{c.get('p','')}\nIR: {c.get('p_irr','')}",
-            f"change: {c.get('d','')}",
-            f"change%: {c.get('dp','')}",
-            f"highest-24h: {cr.get('highest-24h-usd','')}",
-            f"highest-7d: {cr.get('highest-7d-usd','')}",
-            f"volume📊: {c.get('volume','')}",
-            f"volatility: {cr.get('volatility-usd','')}",
-            "***********************************",
-        ]
-    await update.message.reply_text("\n".join(lines))
+        return await update.effective_message.reply_text("example... /search BTC")
+    await _search_page(update.effective_message, symbol, page)
 
-# Gold & currency handlers (copied unchanged from your two parts)
-# ... (goldons, goldprice, seke_retails, sekee, stockm_gold, stockm_seke,
-#       a_currencies, a_currency, e_currencies, excel_file) ...
+# --Gold & currency views
+# command/callback name -> (header label, header key, [(row label, key), ...]).
+# Each row shows d["current"][key]["p"]; the header shows that block's t/ts.
+GOLD_VIEWS: Dict[str, Tuple[str, str, List[Tuple[str, str]]]] = {
+    "goldons": ("اُنس    ", "ons", [
+        ("طلا", "ons"), ("نقره", "silver"), ("پلاتینیوم", "platinum"), ("پالادیوم", "palladium"),
+    ]),
+    "goldprice": ("قیمت طلا ", "geram18", [
+        ("18 ایار", "geram18"), ("24 ایار", "geram24"), ("مثقال", "mesghal"),
+        ("آب شد", "gold_17_transfer"), ("حباب آب شد", "gold_futures"),
+        ("مثقال بدون حباب", "gold_17"), ("طلا دسته دوم", "gold_mini_size"),
+        ("گرم نقره 999", "silver_999"),
+    ]),
+    "seke_retails": ("سکه تک فروشی   ", "retail_sekee", [
+        ("امام", "retail_sekee"), ("بهارآزادی", "retail_sekeb"), ("نیم", "retail_nim"),
+        ("ربع", "retail_rob"), ("گرمی", "retail_gerami"),
+    ]),
+    "sekee": ("سکه   ", "sekee", [
+        ("امام", "sekee"), ("بهارآزادی", "sekeb"), ("نیم", "nim"), ("ربع", "rob"), ("گرمی", "gerami"),
+    ]),
+    "stockm_gold": ("صندوق های طلا در بورس  ", "gc10", [
+        ("گوهر", "gc10"), ("لوتوس", "gc1"), ("مفید", "gc3"), ("زر", "gc11"),
+    ]),
+    "stockm_seke": ("تمام سکه ", "gc19", [
+        ("صادرات", "gc19"), ("آینده", "gc18"), ("سامان", "gc17"), ("رفاه", "gc15"), ("ملت", "gc14"),
+    ]),
+    "a_currencies": ("ارز کشورهای آسیایی: ", "price_cny", [
+        ("یوان چین", "price_cny"), ("روبل روسیه", "price_rub"), ("ین ژاپن", "price_jpy"),
+        ("وون کره", "price_krw"), ("دلار هنگ کنگ", "price_hkd"), ("دلار سنگاپور", "price_sgd"),
+        ("رینگیت مالزی", "price_myr"), ("لیر ترکیه", "price_try"), ("بات تایلند", "price_thb"),
+        ("افغانی", "price_afn"),
+    ]),
+    "a_currency": ("کشورهای عربی خلیج فارس: ", "price_iqd", [
+        ("ریال عربستان", "price_sar"), ("ریال قطر", "price_qar"), ("ریال عمان", "price_omr"),
+        ("دینار کویت", "price_kwd"), ("دینار بحرین", "price_bhd"), ("دینار عراق", "price_iqd"),
+        ("لیر سوریه", "price_syp"), ("درهم امارات", "price_aed"),
+    ]),
+    "e_currencies": ("کشورهای غرب:    ", "price_dollar_rl", [
+        ("دلار", "price_dollar_rl"), ("یورو", "price_eur"), ("پوند انگلیس", "price_gbp"),
+        ("فرانک سویس", "price_chf"), ("دلار کانادا", "price_cad"), ("دلار استرالیا", "price_aud"),
+        ("دلار نیوزلند", "price_nzd"),
+    ]),
+}
 
-async def goldons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    msg = "No data found."
-    d = await fetch_gold_data()
-    if d:
-        try:
-            n = d["current"]
-            blk = n["ons"]
-            lines = [
-                f"اُنس    {blk.get('t','')}\n{blk.get('ts','')}",
-                f"طلا: {blk.get('p','')}",
-                f"نقره: {n.get('silver',{}).get('p','')}",
-                f"پلاتینیوم: {n.get('platinum',{}).get('p','')}",
-                f"پالادیوم: {n.get('palladium',{}).get('p','')}",
-            ]
-            msg = "\n".join(lines)
-        except KeyError:
-            pass
-    await update.message.reply_text(msg)
+def _render_view(name: str, current: Dict[str, Quote]) -> str:
+    label, key, rows = GOLD_VIEWS[name]
+    hdr = current.get(key)
+    if hdr is None:
+        return "No data found."
+    lines = [f"{label}{hdr.t}\n{hdr.ts}"]
+    lines += [f"{row}: {_fmt_num(current[k].p) if k in current else ''}" for row, k in rows]
+    return "\n".join(lines)
 
-async def goldprice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    msg = "No data found."
-    d = await fetch_gold_data()
-    if d:
-        try:
-            n = d["current"]
-            g18 = n.get("geram18",{})
-            lines = [
-                f"قیمت طلا {g18.get('t','')}\n{g18.get('ts','')}",
-                f"18 ایار: {g18.get('p','')}",
-                f"24 ایار: {n.get('geram24',{}).get('p','')}",
-                f"مثقال: {n.get('mesghal',{}).get('p','')}",
-                f"آب شد: {n.get('gold_17_transfer',{}).get('p','')}",
-                f"حباب آب شد: {n.get('gold_futures',{}).get('p','')}",
-                f"مثقال بدون حباب: {n.get('gold_17',{}).get('p','')}",
-                f"طلا دسته دوم: {n.get('gold_mini_size',{}).get('p','')}",
-                f"گرم نقره 999: {n.get('silver_999',{}).get('p','')}",
-            ]
-            msg = "\n".join(lines)
-        except KeyError:
-            pass
-    await update.message.reply_text(msg)
+# Finished texts for the current gold snapshot, rendered once per version.
+_view_texts: Dict[str, str] = {}
 
-async def seke_retails(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    msg = "No data found."
+def _render_views(d: Dict[str, Quote], version: int) -> None:
+    global _view_texts
+    _view_texts = {name: _render_view(name, d) for name in GOLD_VIEWS}
+
+_gold_cache.subscribe(_render_views)
+
+async def _render_gold_view(name: str) -> str:
     d = await fetch_gold_data()
-    if d:
+    if not d or name not in _view_texts:
+        return "No data found."
+    return _view_texts[name] + _age_note(_gold_cache)
+
+def _view_handler(name: str):
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        await update.effective_message.reply_text(await _render_gold_view(name))
+    handler.__name__ = name
+    return handler
+
+VIEW_HANDLERS = {name: _view_handler(name) for name in GOLD_VIEWS}
+
+# --Price alerts
+def _beyond(op: int, price: float, threshold: float) -> bool:
+    # False for an unknown (nan) price
+    return price >= threshold if op > 0 else price <= threshold
+
+class _AlertTable:
+    """Alert subscriptions as parallel NumPy columns, checked in one pass per tick.
+
+    An alert fires when its price crosses the threshold while armed, then
+    disarms until the price moves back past the threshold by ALERT_HYSTERESIS
+    and waits at least ALERT_COOLDOWN between firings. One added while the
+    price is already beyond it starts disarmed. Row ids are stable
+    (freed rows are reused); `ext` holds the id users see, which is the row
+    id itself unless the table mirrors an _AlertStore.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.n = 0
+        self.capacity = capacity
+        self.names: List[str] = []
+        self._ids: Dict[str, int] = {}
+        self._free: List[int] = []
+        self.sym = self.op = self.threshold = self.chat = self.ext = None
+        self.active = self.armed = self.last_fired = None
+
+    def _alloc(self) -> None:
+        # Columns (and NumPy itself) are only needed once someone adds an alert.
+        np = _numpy()
+        size = self.capacity
+        self.sym = np.zeros(size, np.int32)
+        self.op = np.zeros(size, np.int8)        # +1: price >= threshold, -1: price <= threshold
+        self.threshold = np.zeros(size, np.float64)
+        self.chat = np.zeros(size, np.int64)
+        self.ext = np.zeros(size, np.int64)
+        self.active = np.zeros(size, bool)
+        self.armed = np.zeros(size, bool)
+        self.last_fired = np.zeros(size, np.float64)
+
+    def _grow(self) -> None:
+        for col in ("sym", "op", "threshold", "chat", "ext", "active", "armed", "last_fired"):
+            old = getattr(self, col)
+            new = np.zeros(len(old) * 2, old.dtype)
+            new[: len(old)] = old
+            setattr(self, col, new)
+
+    def name_id(self, name: str) -> int:
+        sid = self._ids.get(name)
+        if sid is None:
+            sid = self._ids[name] = len(self.names)
+            self.names.append(name)
+        return sid
+
+    def add(self, chat_id: int, name: str, op: int, threshold: float, ext: Optional[int] = None,
+            price: float = math.nan) -> int:
+        if self.sym is None:
+            self._alloc()
+        if self._free:
+            i = self._free.pop()
+        else:
+            if self.n == len(self.sym):
+                self._grow()
+            i = self.n
+            self.n += 1
+        self.sym[i] = self.name_id(name)
+        self.op[i] = op
+        self.threshold[i] = threshold
+        self.chat[i] = chat_id
+        self.ext[i] = i if ext is None else ext
+        self.active[i] = True
+        self.armed[i] = not _beyond(op, price, threshold)
+        self.last_fired[i] = -math.inf
+        return i
+
+    def remove(self, chat_id: int, i: int) -> bool:
+        if not (0 <= i < self.n and self.active[i] and self.chat[i] == chat_id):
+            return False
+        self.active[i] = False
+        self._free.append(i)
+        return True
+
+    def for_chat(self, chat_id: int) -> List[int]:
+        if not self.n:
+            return []
+        return np.flatnonzero(self.active[: self.n] & (self.chat[: self.n] == chat_id)).tolist()
+
+    def evaluate(self, prices: Any, now: float) -> Any:
+        # prices[name_id] -> latest price (nan when unknown); returns fired row ids
+        n = self.n
+        p = prices[self.sym[:n]]
+        thr = self.threshold[:n]
+        up = self.op[:n] > 0
+        band = np.abs(thr) * ALERT_HYSTERESIS
+        with np.errstate(invalid="ignore"):
+            beyond = np.where(up, p >= thr, p <= thr)
+            back = np.where(up, p < thr - band, p > thr + band)
+        active, armed = self.active[:n], self.armed[:n]
+        fire = active & armed & beyond & (now - self.last_fired[:n] >= ALERT_COOLDOWN)
+        armed &= ~fire
+        armed |= active & back
+        self.last_fired[:n][fire] = now
+        return np.flatnonzero(fire)
+
+alerts = _AlertTable()
+
+class _AlertStore:
+    """Alert subscriptions in SQLite under SHARED_DIR, for multi-worker setups.
+
+    Any worker adds, lists and deletes rows (from a thread, never on the
+    loop); only the snapshot leader evaluates them, by mirroring the file
+    into `alerts` whenever its data_version moves. Row ids are the ids users see.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        db = self._connect()
         try:
-            n = d["current"]["retail_sekee"]
-            r  = d["current"]
-            lines = [
-                f"سکه تک فروشی   {n.get('t','')}\n{n.get('ts','')}",
-                f"امام: {n.get('p','')}",
-                f"بهارآزادی: {r.get('retail_sekeb',{}).get('p','')}",
-                f"نیم: {r.get('retail_nim',{}).get('p','')}",
-                f"ربع: {r.get('retail_rob',{}).get('p','')}",
-                f"گرمی: {r.get('retail_gerami',{}).get('p','')}",
-            ]
-            msg = "\n".join(lines)
-        except KeyError:
-            pass
-    await update.message.reply_text(msg)
+            with db:
+                db.execute("CREATE TABLE IF NOT EXISTS alerts (id INTEGER PRIMARY KEY, "
+                           "chat_id INTEGER, name TEXT, op INTEGER, threshold REAL)")
+        finally:
+            db.close()
+        self._watch: Optional[sqlite3.Connection] = None
 
-async def sekee(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    msg = "No data found."
-    d = await fetch_gold_data()
-    if d:
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5)
+
+    def add(self, chat_id: int, name: str, op: int, threshold: float) -> Optional[int]:
+        # None when the chat is already at ALERT_MAX_PER_CHAT
+        db = self._connect()
         try:
-            n = d["current"]["sekee"]
-            r = d["current"]
-            title = n.get("t") or n.get("t-g","")
-            lines = [
-                f"سکه   {title}\n{n.get('ts','')}",
-                f"امام: {n.get('p','')}",
-                f"بهارآزادی: {r.get('sekeb',{}).get('p','')}",
-                f"نیم: {r.get('nim',{}).get('p','')}",
-                f"ربع: {r.get('rob',{}).get('p','')}",
-                f"گرمی: {r.get('gerami',{}).get('p','')}",
-            ]
-            msg = "\n".join(lines)
-        except KeyError:
-            pass
-    await update.message.reply_text(msg)
+            with db:
+                (n,) = db.execute("SELECT COUNT(*) FROM alerts WHERE chat_id = ?", (chat_id,)).fetchone()
+                if n >= ALERT_MAX_PER_CHAT:
+                    return None
+                return db.execute("INSERT INTO alerts (chat_id, name, op, threshold) VALUES (?, ?, ?, ?)",
+                                  (chat_id, name, op, threshold)).lastrowid
+        finally:
+            db.close()
 
-async def stockm_gold(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    msg = "No data found."
-    d = await fetch_gold_data()
-    if d:
+    def remove(self, chat_id: int, ext: int) -> bool:
+        db = self._connect()
         try:
-            n = d["current"]["gc10"]
-            r = d["current"]
-            lines = [
-                f"صندوق های طلا در بورس  {n.get('t','')}\n{n.get('ts','')}",
-                f"گوهر: {n.get('p','')}",
-                f"لوتوس: {r.get('gc1',{}).get('p','')}",
-                f"مفید: {r.get('gc3',{}).get('p','')}",
-                f"زر: {r.get('gc11',{}).get('p','')}",
-            ]
-            msg = "\n".join(lines)
-        except KeyError:
-            pass
-    await update.message.reply_text(msg)
+            with db:
+                return db.execute("DELETE FROM alerts WHERE id = ? AND chat_id = ?", (ext, chat_id)).rowcount > 0
+        finally:
+            db.close()
 
-async def stockm_seke(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    msg = "No data found."
-    d = await fetch_gold_data()
-    if d:
+    def for_chat(self, chat_id: int) -> List[Tuple[int, str, int, float]]:
+        db = self._connect()
         try:
-            n = d["current"]["gc19"]
-            r = d["current"]
-            lines = [
-                f"تمام سکه {n.get('t','')}\n{n.get('ts','')}",
-                f"صادرات: {n.get('p','')}",
-                f"آینده: {r.get('gc18',{}).get('p','')}",
-                f"سامان: {r.get('gc17',{}).get('p','')}",
-                f"رفاه: {r.get('gc15',{}).get('p','')}",
-                f"ملت: {r.get('gc14',{}).get('p','')}",
-            ]
-            msg = "\n".join(lines)
-        except KeyError:
-            pass
-    await update.message.reply_text(msg)
+            return db.execute("SELECT id, name, op, threshold FROM alerts WHERE chat_id = ? ORDER BY id",
+                              (chat_id,)).fetchall()
+        finally:
+            db.close()
 
-async def a_currencies(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    msg = "No data found."
-    d = await fetch_gold_data()
-    if d:
+    def version(self) -> int:
+        # changes whenever any other connection commits to the file
+        if self._watch is None:
+            self._watch = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        return self._watch.execute("PRAGMA data_version").fetchone()[0]
+
+    def load(self) -> List[Tuple[int, int, str, int, float]]:
+        db = self._connect()
         try:
-            hdr = d["current"]["price_cny"]
-            lines = [
-                f"ارز کشورهای آسیایی: {hdr.get('t','')}\n{hdr.get('ts','')}",
-                f"یوان چین: {d['current'].get('price_cny',{}).get('p','')}",
-                f"روبل روسیه: {d['current'].get('price_rub',{}).get('p','')}",
-                f"ین ژاپن: {d['current'].get('price_jpy',{}).get('p','')}",
-                f"وون کره: {d['current'].get('price_krw',{}).get('p','')}",
-                f"دلار هنگ کنگ: {d['current'].get('price_hkd',{}).get('p','')}",
-                f"دلار سنگاپور: {d['current'].get('price_sgd',{}).get('p','')}",
-                f"رینگیت مالزی: {d['current'].get('price_myr',{}).get('p','')}",
-                f"لیر ترکیه: {d['current'].get('price_try',{}).get('p','')}",
-                f"بات تایلند: {d['current'].get('price_thb',{}).get('p','')}",
-                f"افغانی: {d['current'].get('price_afn',{}).get('p','')}",
-            ]
-            msg = "\n".join(lines)
-        except KeyError:
-            pass
-    await update.message.reply_text(msg)
+            return db.execute("SELECT id, chat_id, name, op, threshold FROM alerts").fetchall()
+        finally:
+            db.close()
 
-async def a_currency(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    msg = "No data found."
-    d = await fetch_gold_data()
-    if d:
+_alert_store: Optional[_AlertStore] = None  # set by _start_feeds when SHARED_DIR is used
+
+def _mirror_alerts(rows: List[Tuple[int, int, str, int, float]]) -> None:
+    # Rebuild `alerts` from the store, keeping armed/cooldown state of surviving rows.
+    global alerts
+    old = alerts
+    keep = {int(old.ext[i]): i for i in range(old.n) if old.active[i]}
+    table = _AlertTable()
+    for ext, chat_id, name, op, threshold in rows:
+        i = table.add(chat_id, name, op, threshold, ext, _alert_prices.get(name, math.nan))
+        j = keep.get(ext)
+        if j is not None:
+            table.armed[i] = old.armed[j]
+            table.last_fired[i] = old.last_fired[j]
+    alerts = table
+
+async def _sync_alerts() -> None:
+    # Leader only: pick up alerts added or deleted on any worker.
+    loop = asyncio.get_running_loop()
+    seen = None
+    while True:
         try:
-            hdr = d["current"]["price_iqd"]
-            lines = [
-                f"کشورهای عربی خلیج فارس: {hdr.get('t','')}\n{hdr.get('ts','')}",
-                f"ریال عربستان: {d['current'].get('price_sar',{}).get('p','')}",
-                f"ریال قطر: {d['current'].get('price_qar',{}).get('p','')}",
-                f"ریال عمان: {d['current'].get('price_omr',{}).get('p','')}",
-                f"دینار کویت: {d['current'].get('price_kwd',{}).get('p','')}",
-                f"دینار بحرین: {d['current'].get('price_bhd',{}).get('p','')}",
-                f"دینار عراق: {d['current'].get('price_iqd',{}).get('p','')}",
-                f"لیر سوریه: {d['current'].get('price_syp',{}).get('p','')}",
-                f"درهم امارات: {d['current'].get('price_aed',{}).get('p','')}",
-            ]
-            msg = "\n".join(lines)
-        except KeyError:
-            pass
-    await update.message.reply_text(msg)
+            version = await loop.run_in_executor(None, _alert_store.version)
+            if version != seen:
+                _mirror_alerts(await loop.run_in_executor(None, _alert_store.load))
+                seen = version
+        except Exception:
+            log.exception("alert sync failed")
+        await asyncio.sleep(SHARED_POLL)
 
-async def e_currencies(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    msg = "No data found."
-    d = await fetch_gold_data()
-    if d:
+async def _alerts_for_chat(chat_id: int) -> List[Tuple[int, str, int, float]]:
+    if _alert_store is not None:
+        return await asyncio.get_running_loop().run_in_executor(None, _alert_store.for_chat, chat_id)
+    return [(int(alerts.ext[i]), alerts.names[alerts.sym[i]], int(alerts.op[i]), float(alerts.threshold[i]))
+            for i in alerts.for_chat(chat_id)]
+
+_alert_polling = False
+
+def _poll_for_alerts() -> None:
+    # Alerts need prices that refresh on their own; without POLL_INTERVAL a
+    # lone process only fetches when a command asks. (With SHARED_DIR the
+    # leader always polls.)
+    global _alert_polling
+    if _alert_polling or POLL_INTERVAL > 0:
+        return
+    _alert_polling = True
+    _bg_tasks.extend(asyncio.ensure_future(_poll(c, CACHE_TTL)) for c in (_crypto_cache, _gold_cache))
+
+async def _add_alert(chat_id: int, name: str, op: int, threshold: float) -> Optional[int]:
+    if _alert_store is not None:
+        return await asyncio.get_running_loop().run_in_executor(
+            None, _alert_store.add, chat_id, name, op, threshold)
+    if len(alerts.for_chat(chat_id)) >= ALERT_MAX_PER_CHAT:
+        return None
+    _poll_for_alerts()
+    return alerts.add(chat_id, name, op, threshold, price=_alert_prices.get(name, math.nan))
+
+async def _remove_alert(chat_id: int, ext: int) -> bool:
+    if _alert_store is not None:
+        return await asyncio.get_running_loop().run_in_executor(None, _alert_store.remove, chat_id, ext)
+    return alerts.remove(chat_id, ext)
+
+_alert_prices: Dict[str, float] = {}  # latest price per alertable name, crypto and gold
+_GOLD_KEYS = {key for _, _, rows in GOLD_VIEWS.values() for _, key in rows}
+
+def _alert_name(sym: str) -> str:
+    # Gold/currency keys (geram18, price_dollar_rl) are lower-case, crypto symbols upper-case.
+    low = sym.lower()
+    return low if low in _GOLD_KEYS or low in _alert_prices else sym.upper()
+
+def _on_crypto_alerts(coins: List[Coin], version: int) -> None:
+    for c in coins:
+        if c.symbol:
+            _alert_prices[c.symbol.upper()] = c.p
+    _check_alerts()
+
+def _on_gold_alerts(d: Dict[str, Quote], version: int) -> None:
+    for key, q in d.items():
+        _alert_prices[key.lower()] = q.p
+    _check_alerts()
+
+def _check_alerts() -> None:
+    if not alerts.n:
+        return
+    table = alerts
+    prices = np.array([_alert_prices.get(name, math.nan) for name in table.names])
+    fired = table.evaluate(prices, time.time())
+    if len(fired):
+        # Resolve the rows now: while bulk sends wait for tokens a row may be
+        # deleted and reused by another chat, or the table swapped by a sync.
+        asyncio.ensure_future(_send_alerts([
+            (int(table.chat[i]), table.names[table.sym[i]], int(table.op[i]),
+             float(table.threshold[i]), float(prices[table.sym[i]]), int(table.ext[i]))
+            for i in fired.tolist()]))
+
+async def _send_alerts(fired: List[Tuple[int, str, int, float, float, int]]) -> None:
+    for chat_id, name, op, threshold, price, ext in fired:
         try:
-            hdr = d["current"]["price_dollar_rl"]
-            lines = [
-                f"کشورهای غرب:    {hdr.get('t','')}\n{hdr.get('ts','')}",
-                f"دلار: {hdr.get('p','')}",
-                f"یورو: {d['current'].get('price_eur',{}).get('p','')}",
-                f"پوند انگلیس: {d['current'].get('price_gbp',{}).get('p','')}",
-                f"فرانک سویس: {d['current'].get('price_chf',{}).get('p','')}",
-                f"دلار کانادا: {d['current'].get('price_cad',{}).get('p','')}",
-                f"دلار استرالیا: {d['current'].get('price_aud',{}).get('p','')}",
-                f"دلار نیوزلند: {d['current'].get('price_nzd',{}).get('p','')}",
-            ]
-            msg = "\n".join(lines)
-        except KeyError:
-            pass
-    await update.message.reply_text(msg)
+            await tg_app.bot.send_message(
+                chat_id=chat_id,
+                text=f"🔔 {name} {'>=' if op > 0 else '<='} {_fmt_price(threshold)}\n"
+                     f"now: {_fmt_price(price)}  (#{ext})",
+                rate_limit_args={"priority": "bulk", "coalesce": f"alert:{ext}"},
+            )
+        except Exception as e:
+            log.error("alert %s to %s failed: %s", ext, chat_id, e)
 
-async def excel_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    rows: List[Dict[str, Any]] = []
-    for snap in bot_data:
-        if isinstance(snap, list):
-            rows.extend(snap)
-        elif isinstance(snap, dict):
-            rows.append(snap)
-    if not rows:
-        return await update.message.reply_text("No data captured yet. Use /top first.")
-    df = pd.DataFrame(rows)
-    df.to_excel("telegram_bot_data.xlsx", index=False)
-    await update.message.reply_text("دریافت اکسل: telegram_bot_data.xlsx")
+_crypto_cache.subscribe(_on_crypto_alerts)
+_gold_cache.subscribe(_on_gold_alerts)
 
-# --Menu & Callback
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /history SYM [1m|15m|1h|1d]
+    args = list(context.args or [])
+    if not args or len(args) > 2 or (len(args) == 2 and args[1].lower() not in CANDLE_RESOLUTIONS):
+        return await update.effective_message.reply_text(
+            f"Usage: /history <SYM> [{'|'.join(CANDLE_RESOLUTIONS)}]  e.g. /history geram18 1h")
+    res = args[1].lower() if len(args) == 2 else "1h"
+    name = candles.lookup(args[0])
+    if name is None:
+        # a fresh process may not have seen a snapshot yet
+        await asyncio.gather(get_crypto_data(), fetch_gold_data())
+        name = candles.lookup(args[0])
+    if name is None:
+        return await update.effective_message.reply_text(f'"{args[0]}" not found.')
+    await update.effective_message.reply_text(_history_text(name, res))
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+ALERT_USAGE = "example... /alert BTC > 65000  |  /alert geram18 < 40000000"
 
-async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    log.info("✅ menu() triggered by user %s", update.effective_user.id)
+async def alert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # /alert SYM >|< PRICE   /alert list   /alert del ID
+    args = list(context.args or [])
+    chat_id = update.effective_chat.id
+    if not args or args[0].lower() == "list":
+        mine = await _alerts_for_chat(chat_id)
+        if not mine:
+            return await update.effective_message.reply_text("No alerts. example... /alert BTC > 65000")
+        lines = [f"#{ext} {name} {'>=' if op > 0 else '<='} {_fmt_price(threshold)}"
+                 for ext, name, op, threshold in mine]
+        return await update.effective_message.reply_text("\n".join(lines))
+    if args[0].lower() in ("del", "delete", "rm") and len(args) == 2 and args[1].lstrip("#").isdigit():
+        ok = await _remove_alert(chat_id, int(args[1].lstrip("#")))
+        return await update.effective_message.reply_text("Alert removed." if ok else "No such alert.")
+    if len(args) != 3 or args[1] not in (">", ">=", "<", "<=") or math.isnan(_num(args[2])):
+        return await update.effective_message.reply_text(ALERT_USAGE)
+    name = _alert_name(args[0])
+    if name not in _alert_prices:
+        # nothing seen yet under this name: let both feeds report in first
+        crypto, gold = await asyncio.gather(get_crypto_data(), fetch_gold_data())
+        name = _alert_name(args[0])
+        if name not in _alert_prices:
+            if crypto is None or gold is None:
+                return await update.effective_message.reply_text("Prices are unavailable right now, try again shortly.")
+            return await update.effective_message.reply_text(f"Unknown symbol {args[0]}. {ALERT_USAGE}")
+    op, threshold = (1 if args[1].startswith(">") else -1), _num(args[2])
+    i = await _add_alert(chat_id, name, op, threshold)
+    if i is None:
+        return await update.effective_message.reply_text(f"Limit is {ALERT_MAX_PER_CHAT} alerts per chat.")
+    note = ""
+    if _beyond(op, _alert_prices[name], threshold):
+        note = f"\nnow {_fmt_price(_alert_prices[name])}, already past it: fires on the next crossing"
+    await update.effective_message.reply_text(f"✅ Alert #{i}: {name} {args[1]} {args[2]}{note}")
 
-    keyboard = [
-        [InlineKeyboardButton("🔍 Test Button", callback_data="test")]
-    ]
-    markup = InlineKeyboardMarkup(keyboard)
+# --Export
+EXPORT_COLUMNS = ["time", "symbol", "price", "price_irr", "volume"]
+_export_pool = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+_exports: Dict[Tuple[Any, ...], List[Any]] = {}  # key -> [future, waiters]
+
+def _export_rows(history: _PriceHistory, since: Optional[float],
+                 symbols: Optional[List[str]]) -> Iterator[List[Any]]:
+    for ts, symbol, price, price_irr, volume in history.rows(since=since, symbols=symbols):
+        yield [
+            datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None),
+            symbol,
+            *(None if v is None or math.isnan(v) else v for v in (price, price_irr, volume)),
+        ]
+
+def _write_export(history: _PriceHistory, fmt: str, since: Optional[float],
+                  symbols: Optional[List[str]]) -> Tuple[str, int]:
+    # Runs in _export_pool on a frozen() history; rows are streamed to disk,
+    # never collected in a list.
+    fd, path = tempfile.mkstemp(prefix="bazarroz-", suffix=f".{fmt}")
+    os.close(fd)
+    count = 0
+    try:
+        if fmt == "csv":
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                w = csv.writer(f)
+                w.writerow(EXPORT_COLUMNS)
+                for count, row in enumerate(_export_rows(history, since, symbols), 1):
+                    w.writerow(row)
+        elif fmt == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = pa.schema([("time", pa.timestamp("s")), ("symbol", pa.string()),
+                                ("price", pa.float64()), ("price_irr", pa.float64()),
+                                ("volume", pa.float64())])
+            with pq.ParquetWriter(path, schema) as w:
+                batch: List[List[Any]] = []
+                for count, row in enumerate(_export_rows(history, since, symbols), 1):
+                    batch.append(row)
+                    if len(batch) == 10_000:
+                        w.write_table(pa.Table.from_pylist(
+                            [dict(zip(EXPORT_COLUMNS, r)) for r in batch], schema=schema))
+                        batch.clear()
+                if batch:
+                    w.write_table(pa.Table.from_pylist(
+                        [dict(zip(EXPORT_COLUMNS, r)) for r in batch], schema=schema))
+        else:
+            from openpyxl import Workbook
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet("prices")
+            ws.append(EXPORT_COLUMNS)
+            for count, row in enumerate(_export_rows(history, since, symbols), 1):
+                ws.append(row)
+            wb.save(path)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path, count
+
+def _parse_export_args(args: List[str]) -> Tuple[str, Optional[float], Optional[List[str]]]:
+    # /excel_file [xlsx|csv|parquet] [hours] [SYM,SYM...]
+    fmt, hours, symbols = "xlsx", None, []
+    for a in args:
+        if a.lower() in EXPORT_FORMATS:
+            fmt = a.lower()
+        elif a.replace(".", "", 1).isdigit():
+            hours = float(a)
+        else:
+            symbols += [s.upper() for s in a.split(",") if s]
+    return fmt, hours, symbols or None
+
+async def excel_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    fmt, hours, symbols = _parse_export_args(list(context.args or []))
+    if hours is not None and hours <= 0:
+        return await update.effective_message.reply_text(
+            "Hours must be positive. example... /excel_file csv 24 BTC,ETH")
+    if not len(price_history) and not price_history.db_path:
+        return await update.effective_message.reply_text("No data captured yet. Use /top first.")
+    # Identical requests that overlap share one generated file; the last
+    # one to finish uploading deletes it.
+    key = (fmt, hours, tuple(symbols or ()), price_history.last_key)
+    entry = _exports.get(key)
+    if entry is None:
+        since = time.time() - hours * 3600 if hours is not None else None
+        loop = asyncio.get_running_loop()
+        entry = _exports[key] = [loop.run_in_executor(
+            _export_pool, _write_export, price_history.frozen(), fmt, since, symbols), 0]
+    entry[1] += 1
+    path = None
+    try:
+        path, count = await asyncio.shield(entry[0])
+        if not count:
+            return await update.effective_message.reply_text("No data captured yet. Use /top first.")
+        caption = f"دریافت اکسل: {count} ردیف"
+        covered = price_history.span()
+        if not price_history.db_path and (hours is None or hours * 3600 > covered + HISTORY_INTERVAL):
+            # say how far back the file goes, rather than let it pass for the full range
+            caption += f" (از {covered / 3600:.1f} ساعت اخیر)"
+        with open(path, "rb") as f:
+            await update.effective_message.reply_document(
+                document=f,
+                filename=f"telegram_bot_data.{fmt}",
+                caption=caption,
+            )
+    except ImportError:
+        await update.effective_message.reply_text(f"{fmt} export is not available on this server.")
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            _exports.pop(key, None)
+            if path:
+                os.unlink(path)
+
+# --Menu & Callback
+HELP_TEXT = (
+    "📜 راهنما:\n"
+    "/start – شروع\n"
+    "/menu – نمایش دکمه‌ها\n"
+    "/top – رمزارزهای برتر\n"
+    "/search <SYM> – جستجو\n"
+    "/goldons /goldprice /seke_retails /sekee\n"
+    "/stockm_gold /stockm_seke\n"
+    "/a_currencies /a_currency /e_currencies\n"
+    "/excel_file – دریافت اکسل\n"
+    "/alert <SYM> > <price> – هشدار قیمت\n"
+    "/history <SYM> [1m|15m|1h|1d] – تاریخچه قیمت\n"
+    "@bot btc یا @bot dollar – قیمت در هر چتی (اینلاین)"
+)
+SEARCH_PROMPT = "برای جستجو، دستور /search <نام ارز> را بزنید"
+ALERT_PROMPT = (
+    "برای هشدار قیمت، دستور /alert <نماد> > <قیمت> را بزنید\n"
+    "مثال: /alert BTC > 65000  |  /alert geram18 < 40000000\n"
+    "/alert list – هشدارهای من    /alert del <شماره> – حذف"
+)
+HISTORY_PROMPT = (
+    "برای تاریخچه قیمت، دستور /history <نماد> [1m|15m|1h|1d] را بزنید\n"
+    "مثال: /history BTC 1h  |  /history geram18 1d"
+)
+MENU_TEXT = "📋 منو – یک گزینه را انتخاب کنید:"
+MENU_BUTTONS = [
+    ("💰 رمزارزهای برتر", "top"), ("🔍 جستجو", "search"),
+    ("🔔 هشدار قیمت", "alert"), ("📈 تاریخچه قیمت", "history"),
+    ("اُنس", "goldons"), ("قیمت طلا", "goldprice"),
+    ("سکه تک فروشی", "seke_retails"), ("سکه", "sekee"),
+    ("صندوق های طلا", "stockm_gold"), ("تمام سکه", "stockm_seke"),
+    ("ارز آسیایی", "a_currencies"), ("ارز عربی", "a_currency"),
+    ("ارز غربی", "e_currencies"), ("📥 اکسل", "excel_file"),
+    ("📜 راهنما", "help"), ("📋 منو", "menu"),
+]
+MENU_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(label, callback_data=data) for label, data in MENU_BUTTONS[i:i + 2]]
+     for i in range(0, len(MENU_BUTTONS), 2)]
+)
 
-    await context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text="🧪 Testing inline buttons...",
-        reply_markup=markup
-    )
+async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.effective_message.reply_text(MENU_TEXT, reply_markup=MENU_MARKUP)
 
+# (chat_id, message_id) -> hash of what we last put there; bounded LRU
+_last_edit: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+_edit_counts = {"edited": 0, "skipped": 0}
 
+async def _edit_in_place(q, text: str, markup: Optional[InlineKeyboardMarkup]) -> None:
+    # Skip the API call when the message already shows exactly this content.
+    key = (q.message.chat.id, q.message.message_id)
+    digest = hash((text, markup.to_json() if markup else ""))
+    previous = _last_edit.get(key)
+    if previous is None and q.message.text == text and q.message.reply_markup == markup:
+        previous = digest
+    if previous == digest:
+        _edit_counts["skipped"] += 1
+        _last_edit[key] = digest
+        _last_edit.move_to_end(key)
+        return
+    try:
+        await q.edit_message_text(text, reply_markup=markup)
+        _edit_counts["edited"] += 1
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+        _edit_counts["skipped"] += 1
+    _last_edit[key] = digest
+    _last_edit.move_to_end(key)
+    while len(_last_edit) > 10_000:
+        _last_edit.popitem(last=False)
 
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q    = update.callback_query
     data = (q.data or "").strip()
-    # Debug: confirm PTB received the callback
-    log.info("💡 PTB on_callback fired with data=%s", data)
+    log.debug("on_callback data=%s", data)
     # Acknowledge the button tap immediately
     await q.answer()
-    # Redirect update.message so your command handlers work unchanged
-    update.message = q.message
 
-    # Dispatch to your existing handlers
-    if data == "start":
-        await start(update, context)
+    # Menu buttons redraw the menu message itself; search paging redraws the results
+    if data.startswith("search:"):
+        _, page, query = data.split(":", 2)
+        text, markup = await _render_search(query, int(page))
+        return await _edit_in_place(q, text, markup)
+    if data == "excel_file":
+        # a document can't replace a text message, so this one still sends
+        return await excel_file(update, context)
+    if data in ("start", "menu"):
+        text = MENU_TEXT
     elif data == "top":
-        await top(update, context)
+        text = await _render_top()
     elif data == "search":
-        await context.bot.send_message(
-            chat_id=q.message.chat.id,
-            text="برای جستجو، دستور /search <نام ارز> را بزنید"
-        )
-    elif data == "goldons":
-        await goldons(update, context)
-    elif data == "goldprice":
-        await goldprice(update, context)
-    elif data == "seke_retails":
-        await seke_retails(update, context)
-    elif data == "sekee":
-        await sekee(update, context)
-    elif data == "stockm_gold":
-        await stockm_gold(update, context)
-    elif data == "stockm_seke":
-        await stockm_seke(update, context)
-    elif data == "a_currencies":
-        await a_currencies(update, context)
-    elif data == "a_currency":
-        await a_currency(update, context)
-    elif data == "e_currencies":
-        await e_currencies(update, context)
-    elif data == "excel_file":
-        await excel_file(update, context)
+        text = SEARCH_PROMPT
+    elif data == "alert":
+        text = ALERT_PROMPT
+    elif data == "history":
+        text = HISTORY_PROMPT
+    elif data in GOLD_VIEWS:
+        text = await _render_gold_view(data)
     else:
-        await context.bot.send_message(
-            chat_id=q.message.chat.id,
-            text=(
-                "📜 راهنما:\n"
-                "/start – شروع\n"
-                "/menu – نمایش دکمه‌ها\n"
-                "/top – رمزارزهای برتر\n"
-                "/search <SYM> – جستجو\n"
-                "/goldons /goldprice /seke_retails /sekee\n"
-                "/stockm_gold /stockm_seke\n"
-                "/a_currencies /a_currency /e_currencies\n"
-                "/excel_file – دریافت اکسل"
+        text = HELP_TEXT
+    await _edit_in_place(q, text, MENU_MARKUP)
+
+
+# --Inline mode
+def _gold_labels() -> Dict[str, Tuple[str, str]]:
+    # key -> (view label, row label) for every gold/currency key a view shows
+    out: Dict[str, Tuple[str, str]] = {}
+    for label, hdr, rows in GOLD_VIEWS.values():
+        for row, key in rows:
+            out.setdefault(key, (label.strip(" :"), row))
+    for label, hdr, rows in GOLD_VIEWS.values():
+        out.setdefault(hdr, (label.strip(" :"), label.strip(" :")))
+    return out
+
+_GOLD_LABELS = _gold_labels()
+
+# id, title, description, message text
+InlineEntry = Tuple[str, str, str, str]
+
+class _InlineCatalog:
+    """Ready-made inline results for the current crypto and gold snapshots.
+
+    Each feed's entries (texts and search terms) are built once per snapshot
+    version; the PTB article object for an entry is made the first time a
+    query returns it. A query is a prefix search over one sorted term list
+    (symbols, title words, gold keys and labels); answers are kept per query
+    until either feed changes.
+    """
+
+    def __init__(self, limit: int, cache_max: int):
+        self.limit = limit
+        self.cache_max = cache_max
+        self._feeds: Dict[str, List[Tuple[Iterable[str], InlineEntry]]] = {"crypto": [], "gold": []}
+        self._featured: Dict[str, int] = {"crypto": 0, "gold": 0}
+        self.entries: List[InlineEntry] = []
+        self._articles: List[Optional[InlineQueryResultArticle]] = []
+        self.featured: List[int] = []
+        self.terms: List[str] = []
+        self.ids: List[int] = []
+        self._answers: "OrderedDict[str, List[InlineQueryResultArticle]]" = OrderedDict()
+        self.hits = self.misses = 0
+
+    def set_feed(self, feed: str, entries: List[Tuple[Iterable[str], InlineEntry]], featured: int) -> None:
+        # the first `featured` entries of a feed answer an empty query
+        self._feeds[feed] = entries
+        self._featured[feed] = featured
+        flat: List[InlineEntry] = []
+        pairs: List[Tuple[str, int]] = []
+        self.featured = []
+        for name in ("crypto", "gold"):
+            self.featured += range(len(flat), len(flat) + min(self._featured[name], len(self._feeds[name])))
+            for terms, entry in self._feeds[name]:
+                pairs += [(t, len(flat)) for t in terms if t]
+                flat.append(entry)
+        pairs.sort()
+        self.entries = flat
+        self._articles = [None] * len(flat)
+        self.terms = [t for t, _ in pairs]
+        self.ids = [i for _, i in pairs]
+        self._answers.clear()
+
+    def _article(self, i: int) -> InlineQueryResultArticle:
+        article = self._articles[i]
+        if article is None:
+            rid, title, description, text = self.entries[i]
+            article = self._articles[i] = InlineQueryResultArticle(
+                id=rid, title=title, description=description,
+                input_message_content=InputTextMessageContent(text),
             )
-        )
+        return article
+
+    def lookup(self, query: str) -> List[InlineQueryResultArticle]:
+        q = query.strip().casefold()
+        found = self._answers.get(q)
+        if found is not None:
+            self.hits += 1
+            self._answers.move_to_end(q)
+            return found
+        self.misses += 1
+        if not q:
+            found = [self._article(i) for i in self.featured[: self.limit]]
+        else:
+            lo = bisect.bisect_left(self.terms, q)
+            hi = bisect.bisect_left(self.terms, q + "\uffff")
+            # exact term first, then shorter completions, then feed order (crypto by rank)
+            ranked = sorted(range(lo, hi), key=lambda k: (len(self.terms[k]), self.ids[k]))
+            seen: set = set()
+            found = []
+            for k in ranked:
+                i = self.ids[k]
+                if i not in seen:
+                    seen.add(i)
+                    found.append(self._article(i))
+                    if len(found) >= self.limit:
+                        break
+        self._answers[q] = found
+        while len(self._answers) > self.cache_max:
+            self._answers.popitem(last=False)
+        return found
+
+    def info(self) -> Dict[str, Any]:
+        return {"entries": len(self.entries), "articles": sum(a is not None for a in self._articles),
+                "terms": len(self.terms),
+                "cached_queries": len(self._answers), "hits": self.hits, "misses": self.misses}
+
+inline_catalog = _InlineCatalog(INLINE_MAX_RESULTS, INLINE_CACHE_MAX)
+
+def _inline_crypto(coins: List[Coin], version: int) -> None:
+    entries = []
+    for i, c in enumerate(coins):
+        if not c.symbol:
+            continue
+        title = c.title.casefold()
+        entry = (f"c{version}:{i}", f"{c.symbol} · {c.title}",
+                 f"💲{_fmt_num(c.p)}  IR {_fmt_num(c.p_irr)}  ({_fmt_num(c.dp)}%)",
+                 "\n".join(_coin_lines(c)[:-1]))
+        entries.append(({c.symbol.casefold(), title, *title.split()}, entry))
+    inline_catalog.set_feed("crypto", entries, 10)
+
+def _inline_gold(d: Dict[str, Quote], version: int) -> None:
+    # view headers (ons, geram18, sekee, price_dollar_rl...) first: they answer an empty query
+    headers = [hdr for _, hdr, _ in GOLD_VIEWS.values()]
+    keys = headers + [k for k in _GOLD_LABELS if k not in headers]
+    entries = []
+    for key in keys:
+        q = d.get(key)
+        if q is None:
+            continue
+        view, row = _GOLD_LABELS[key]
+        name = q.t or f"{view} {row}"
+        entry = (f"g{version}:{key}", f"{view} – {row}", f"{_fmt_num(q.p)} · {q.ts}",
+                 f"{name}: {_fmt_num(q.p)}\n⏲️ {q.ts}")
+        # price_dollar_rl is found by "dollar", sekee by "سکه" or "امام"
+        terms = {key.casefold(), *key.casefold().split("_"), row, *row.split(), view, *view.split()}
+        entries.append((terms - {"price"}, entry))
+    inline_catalog.set_feed("gold", entries, sum(k in d for k in headers))
 
+_crypto_cache.subscribe(_inline_crypto)
+_gold_cache.subscribe(_inline_gold)
+
+def _inline_cache_time() -> int:
+    # Let Telegram answer repeats itself until the older snapshot is due for a refresh.
+    age = max(_crypto_cache.age(), _gold_cache.age())
+    return int(max(min(CACHE_TTL - age, CACHE_TTL), INLINE_MIN_CACHE))
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    iq = update.inline_query
+    # same budget as /search: past it we answer from whatever is already built
+    try:
+        await asyncio.wait_for(asyncio.shield(asyncio.gather(get_crypto_data(), fetch_gold_data())),
+                               SEARCH_BUDGET)
+    except asyncio.TimeoutError:
+        log.warning("inline budget exceeded, answering from last snapshot")
+    await iq.answer(inline_catalog.lookup(iq.query), cache_time=_inline_cache_time())
+
+# --Outbound Telegram scheduler
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self, now: float) -> float:
+        # Take a token now, possibly going into debt; returns how long to wait for it.
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class _SendScheduler(BaseRateLimiter):
+    """Rate limiter in front of tg_app.bot.
+
+    Requests that target a chat take a token from a global bucket and from
+    that chat's bucket. Interactive requests (the default) reserve tokens
+    immediately; bulk requests (rate_limit_args={"priority": "bulk"}) go one
+    at a time and only use spare global capacity, so they never delay a
+    reply. A bulk request with a "coalesce" key is dropped if a newer one with
+    the same key for the same chat was queued meanwhile: process_request
+    returns {} without calling Telegram, and the bot method returns None.
+    RetryAfter pauses every request for the advised time and retries.
+    """
+
+    def __init__(self):
+        self._global = _TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._chats: "OrderedDict[Any, _TokenBucket]" = OrderedDict()  # LRU, oldest first
+        self._latest: Dict[Tuple[Any, Any], object] = {}
+        self._bulk_lock: Optional[asyncio.Lock] = None
+        self._paused_until = 0.0
+        self.queued = {"interactive": 0, "bulk": 0}
+        self.counts = {"sent": 0, "superseded": 0, "retry_after": 0}
+        self.wait_total = self.wait_max = 0.0
+
+    async def initialize(self) -> None:
+        self._bulk_lock = asyncio.Lock()
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+        self._latest.clear()
+
+    def _chat_bucket(self, chat_id: Any) -> _TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is not None:
+            self._chats.move_to_end(chat_id)
+            return bucket
+        if len(self._chats) >= 10_000:
+            # the least recently used chat has long since refilled its bucket
+            self._chats.popitem(last=False)
+        private = not str(chat_id).startswith("-")
+        bucket = self._chats[chat_id] = _TokenBucket(TG_CHAT_RATE if private else TG_GROUP_RATE,
+                                                     TG_CHAT_BURST)
+        return bucket
+
+    async def _acquire(self, chat_id: Any, bulk: bool) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            chat = self._chat_bucket(chat_id)
+            if not bulk:
+                await asyncio.sleep(max(self._global.reserve(now), chat.reserve(now)))
+                return
+            wait = max(self._global.wait_time(now), chat.wait_time(now))
+            if wait <= 0 and not self.queued["interactive"]:
+                self._global.reserve(now)
+                chat.reserve(now)
+                return
+            await asyncio.sleep(max(wait, 0.05))
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        opts = rate_limit_args if isinstance(rate_limit_args, dict) else {}
+        bulk = opts.get("priority") == "bulk"
+        coalesce = opts.get("coalesce")
+        if coalesce is not None:
+            token = object()
+            self._latest[(chat_id, coalesce)] = token
+        if chat_id is not None:
+            kind = "bulk" if bulk else "interactive"
+            self.queued[kind] += 1
+            started = time.monotonic()
+            try:
+                if bulk:
+                    async with self._bulk_lock:
+                        await self._acquire(chat_id, bulk)
+                else:
+                    await self._acquire(chat_id, bulk)
+            finally:
+                self.queued[kind] -= 1
+            waited = time.monotonic() - started
+            metrics.observe("bot_telegram_wait_seconds", waited, (("priority", kind),))
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        if coalesce is not None:
+            if self._latest.get((chat_id, coalesce)) is not token:
+                self.counts["superseded"] += 1
+                return {}
+            del self._latest[(chat_id, coalesce)]
+        for attempt in range(TG_MAX_RETRIES + 1):
+            started = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+                self.counts["sent"] += 1
+                return result
+            except RetryAfter as e:
+                metrics.inc("bot_telegram_retry_after_total", (("endpoint", endpoint),))
+                self.counts["retry_after"] += 1
+                if attempt == TG_MAX_RETRIES:
+                    raise
+                log.warning("Telegram flood limit on %s, pausing %ss", endpoint, e.retry_after)
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            finally:
+                metrics.observe("bot_telegram_api_seconds", time.perf_counter() - started,
+                                (("endpoint", endpoint),))
+
+    def info(self) -> Dict[str, Any]:
+        sent = self.counts["sent"]
+        return {
+            **self.counts,
+            "queued": dict(self.queued),
+            "wait_avg": round(self.wait_total / sent, 3) if sent else 0.0,
+            "wait_max": round(self.wait_max, 3),
+            "chats": len(self._chats),
+        }
+
+send_scheduler = _SendScheduler()
 
 # --Build PTB app
-tg_app = ApplicationBuilder().token(TOKEN).build()
-tg_app.add_handler(CommandHandler("menu", menu))
+tg_app = (
+    ApplicationBuilder()
+    .token(TOKEN)
+    .base_url(TELEGRAM_API_BASE)
+    .rate_limiter(send_scheduler)
+    .build()
+)
 # Register command handlers
-tg_app.add_handler(CommandHandler("start", start))
-tg_app.add_handler(CommandHandler("top", top))
-tg_app.add_handler(CommandHandler("search", search))
-tg_app.add_handler(CommandHandler("goldons", goldons))
-tg_app.add_handler(CommandHandler("goldprice", goldprice))
-tg_app.add_handler(CommandHandler("seke_retails", seke_retails))
-tg_app.add_handler(CommandHandler("sekee", sekee))
-tg_app.add_handler(CommandHandler("stockm_gold", stockm_gold))
-tg_app.add_handler(CommandHandler("stockm_seke", stockm_seke))
-tg_app.add_handler(CommandHandler("a_currencies", a_currencies))
-tg_app.add_handler(CommandHandler("a_currency", a_currency))
-tg_app.add_handler(CommandHandler("e_currencies", e_currencies))
-tg_app.add_handler(CommandHandler("excel_file", excel_file))
+COMMANDS = {
+    "menu": menu,
+    "start": start,
+    "top": top,
+    "search": search,
+    **VIEW_HANDLERS,
+    "excel_file": excel_file,
+    "alert": alert,
+    "history": history,
+}
+CALLBACK_LABELS = {"help", "search", *COMMANDS}
+for name, handler in COMMANDS.items():
+    tg_app.add_handler(CommandHandler(name, _timed("command", name, handler)))
 
 # Register callback handler
-tg_app.add_handler(CallbackQueryHandler(on_callback))
+tg_app.add_handler(CallbackQueryHandler(_timed("callback", "", on_callback)))
+tg_app.add_handler(InlineQueryHandler(_timed("inline", "query", inline_query)))
 
-# --Background loop for PTB
-_loop = asyncio.new_event_loop()
-def _run_loop(loop: asyncio.AbstractEventLoop):
-    asyncio.set_event_loop(loop)
-    loop.run_forever()
-threading.Thread(target=_run_loop, args=(_loop,), daemon=True).start()
+# --Lifecycle
+_loop: Optional[asyncio.AbstractEventLoop] = None  # the loop PTB and all handlers run on
+_bg_tasks: List[asyncio.Task] = []
 
-async def _startup():
-    await tg_app.initialize()
-    await tg_app.start()
-    # Auto-set webhook
+_ready = False  # True once PTB is started and updates can be processed
+
+ALLOWED_UPDATES = ["message", "edited_message", "callback_query", "inline_query"]
+
+async def _sync_webhook() -> None:
+    # Always re-register: getWebhookInfo doesn't report the secret token, so
+    # comparing it can't notice a rotated SECRET_TOKEN. Runs in the background,
+    # off the readiness path.
     url = f"{WEBHOOK_BASE}/webhook"
     try:
-        resp = requests.post(
-            f"{TELEGRAM_API}/setWebhook",
-            json={
-                "url": url,
-                "secret_token": SECRET_TOKEN,
-                "allowed_updates": ["message", "edited_message", "callback_query"],
-                "max_connections": 40,
-            },
-            timeout=10,
+        ok = await tg_app.bot.set_webhook(
+            url=url,
+            secret_token=SECRET_TOKEN,
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=40,
         )
-        log.info("setWebhook status=%s body=%s", resp.status_code, resp.text)
+        log.info("setWebhook %s -> %s", url, ok)
     except Exception as e:
         log.error("Failed to setWebhook: %s", e)
-    log.info("✅ PTB startup coroutine scheduled")
-asyncio.run_coroutine_threadsafe(_startup(), _loop)
-# ---------- Flask app & webhook endpoint ----------
+
+async def _startup():
+    global _ready
+    started = time.perf_counter()
+    await tg_app.initialize()
+    await tg_app.start()
+    _http_session()
+    _bg_tasks.append(asyncio.ensure_future(_watch_loop_lag()))
+    leader = await _start_feeds()
+    _ready = True
+    log.info("✅ PTB ready in %.0f ms", (time.perf_counter() - started) * 1000)
+    asyncio.get_running_loop().run_in_executor(None, _warm_imports)
+    if leader:
+        # Auto-set webhook (once, by the leader when several workers share SHARED_DIR)
+        _bg_tasks.append(asyncio.ensure_future(_sync_webhook()))
+
+async def _shutdown():
+    for task in _bg_tasks:
+        task.cancel()
+    if _http is not None and not _http.closed:
+        await _http.close()
+    if tg_app.running:
+        await tg_app.stop()
+    await tg_app.shutdown()
+
+class _UpdateDeduper:
+    """Drops webhook redeliveries and button mashing before PTB sees them.
+
+    An update_id seen within DEDUP_WINDOW is a Telegram retry. A callback
+    with the same callback_data from the same chat within CALLBACK_COALESCE
+    seconds is a repeated tap; it is only answered, so the client stops
+    spinning. Called from WSGI threads, hence the lock. With SHARED_DIR,
+    update_ids are also checked against `shared`, so a redelivery that lands
+    on another worker is still dropped; tap coalescing stays per worker.
+    """
+
+    def __init__(self):
+        self.shared: Optional["_SharedUpdateIds"] = None
+        self._ids: "OrderedDict[int, float]" = OrderedDict()
+        self._taps: "OrderedDict[Tuple[Any, str], float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counts = {"duplicate_updates": 0, "coalesced_callbacks": 0}
+
+    @staticmethod
+    def _expire(seen: "OrderedDict", horizon: float, limit: int) -> None:
+        while seen and (len(seen) > limit or next(iter(seen.values())) < horizon):
+            seen.popitem(last=False)
+
+    def admit(self, update_json: Dict[str, Any]) -> bool:
+        now = time.monotonic()
+        uid = update_json.get("update_id")
+        cq = update_json.get("callback_query")
+        with self._lock:
+            self._expire(self._ids, now - DEDUP_WINDOW, DEDUP_MAX)
+            if uid is not None:
+                if uid in self._ids or (self.shared is not None and self.shared.seen(uid)):
+                    self.counts["duplicate_updates"] += 1
+                    return False
+                self._ids[uid] = now
+            if cq:
+                chat = ((cq.get("message") or {}).get("chat") or {}).get("id") or (cq.get("from") or {}).get("id")
+                key = (chat, cq.get("data") or "")
+                self._expire(self._taps, now - CALLBACK_COALESCE, DEDUP_MAX)
+                if key in self._taps:
+                    self.counts["coalesced_callbacks"] += 1
+                    if _loop is not None and cq.get("id"):
+                        asyncio.run_coroutine_threadsafe(_answer_quietly(cq["id"]), _loop)
+                    return False
+                self._taps[key] = now
+        return True
+
+class _SharedUpdateIds:
+    """Recent update_ids in a file under SHARED_DIR, common to every worker.
+
+    Slot update_id % slots holds the last id that landed there. Telegram
+    numbers updates sequentially, so an id is remembered until `slots`
+    newer ones have arrived. A byte-range lock on the slot makes the
+    check-and-set atomic across processes.
+    """
+
+    def __init__(self, path: str, slots: int):
+        self.slots = slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < 8 * slots:
+            os.ftruncate(self._fd, 8 * slots)
+        self._mm = mmap.mmap(self._fd, 8 * slots)
+        self._ids = memoryview(self._mm).cast("Q")
+
+    def seen(self, uid: int) -> bool:
+        # True if another worker (or we) already took this update_id; records it otherwise.
+        import fcntl
+        i = uid % self.slots
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 8, 8 * i)
+        try:
+            if self._ids[i] == uid + 1:  # +1 so an empty slot (0) never matches
+                return True
+            self._ids[i] = uid + 1
+            return False
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 8, 8 * i)
+
+async def _answer_quietly(callback_query_id: str) -> None:
+    try:
+        await tg_app.bot.answer_callback_query(callback_query_id)
+    except Exception as e:
+        log.debug("answer for coalesced callback failed: %s", e)
+
+_dedup = _UpdateDeduper()
+
+class _ChatDispatcher:
+    """Feeds updates to PTB concurrently across chats, strictly in order within one.
+
+    Each chat with pending updates gets one lane task that processes them
+    one after another; a semaphore caps how many updates run at once over
+    all lanes, so a slow /top in one chat never holds up another chat.
+    Updates without a chat or user get a lane of their own. Loop-only:
+    WSGI threads submit through call_soon_threadsafe.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = self.queued = self.processed = self.failed = 0
+        self._lanes: Dict[Any, deque] = {}
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._idle: Optional[asyncio.Event] = None
+
+    @staticmethod
+    def _key(upd: Update) -> Any:
+        if upd.effective_chat is not None:
+            return upd.effective_chat.id
+        if upd.effective_user is not None:
+            return ("user", upd.effective_user.id)
+        return ("update", upd.update_id)
+
+    def pending(self) -> int:
+        return self.queued + self.in_flight
+
+    def submit(self, upd: Update) -> None:
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.limit)
+            self._idle = asyncio.Event()
+        self._idle.clear()
+        self.queued += 1
+        key = self._key(upd)
+        lane = self._lanes.get(key)
+        if lane is not None:
+            lane.append(upd)  # the lane's task picks it up after the current one
+            return
+        lane = self._lanes[key] = deque([upd])
+        asyncio.ensure_future(self._drain(key, lane))
+
+    async def _drain(self, key: Any, lane: deque) -> None:
+        try:
+            while lane:
+                upd = lane.popleft()
+                async with self._sem:
+                    self.queued -= 1
+                    self.in_flight += 1
+                    try:
+                        await tg_app.process_update(upd)
+                    except Exception:
+                        self.failed += 1
+                        log.exception("Update %s failed", upd.update_id)
+                    finally:
+                        self.in_flight -= 1
+                        self.processed += 1
+        finally:
+            del self._lanes[key]
+            if not self._lanes:
+                self._idle.set()
+
+    async def join(self) -> None:
+        if self._idle is not None and self._lanes:
+            await self._idle.wait()
+
+    def info(self) -> Dict[str, Any]:
+        return {"in_flight": self.in_flight, "queued": self.queued, "chats": len(self._lanes),
+                "limit": self.limit, "processed": self.processed, "failed": self.failed}
+
+dispatcher = _ChatDispatcher(UPDATE_WORKERS)
+
+def _parse_update(update_json: Dict[str, Any]) -> Update:
+    kind = next((k for k in update_json if k != "update_id"), "unknown")
+    log.debug("webhook update %s (%s)", update_json.get("update_id"), kind)
+    return Update.de_json(update_json, tg_app.bot)
+
+def _stats() -> Dict[str, Any]:
+    return {
+        "ingress": INGRESS,
+        "ready": _ready,
+        "updates": {**ingress_stats(), **_dedup.counts},
+        "dispatch": {"pid": os.getpid(), **dispatcher.info()},
+        "http_pool": pool_stats(),
+        "snapshots": snapshot_info(),
+        "upstream": upstream_info(),
+        "shared": shared_info(),
+        "history": price_history.info(),
+        "candles": candles.info(),
+        "inline": inline_catalog.info(),
+        "outbound": send_scheduler.info(),
+        "menu_edits": dict(_edit_counts),
+    }
+
+# ---------- Flask app & webhook endpoint (INGRESS=flask) ----------
+# PTB runs on a loop in a daemon thread; the WSGI threads hand updates to the
+# dispatcher on that loop. At most UPDATE_QUEUE_SIZE may be pending.
+_ingress_counts = {"rejected": 0}
+
+def ingress_stats() -> Dict[str, Any]:
+    stats = {"pending": dispatcher.pending(), "limit": UPDATE_QUEUE_SIZE,
+             "rejected": _ingress_counts["rejected"]}
+    if INGRESS == "aiohttp":
+        stats["draining"] = _draining
+    return stats
+
+def _cache_gauge() -> List[Tuple[Labels, float]]:
+    out = []
+    for c in (_crypto_cache, _gold_cache):
+        for result, n in (("hit", c.hits), ("stale", c.stale_hits), ("miss", c.misses)):
+            out.append(((("feed", c.name), ("result", result)), n))
+    return out
+
+metrics.counter("bot_cache_requests_total", _cache_gauge)
+metrics.gauge("bot_snapshot_age_seconds", lambda: [
+    ((("feed", c.name),), c.age()) for c in (_crypto_cache, _gold_cache) if c.value is not None])
+metrics.gauge("bot_snapshot_version", lambda: [
+    ((("feed", c.name),), c.version) for c in (_crypto_cache, _gold_cache)])
+metrics.gauge("bot_event_loop_lag_last_seconds", lambda: _loop_lag[0])
+metrics.gauge("bot_upstream_breaker_state", lambda: [
+    ((("feed", b.name),), _CircuitBreaker.STATES.index(b.state)) for b in _breakers.values()])
+metrics.counter("bot_upstream_breaker_opened_total", lambda: [
+    ((("feed", b.name),), b.opened) for b in _breakers.values()])
+metrics.gauge("bot_snapshot_leader", lambda: int(_role != "follower"))
+metrics.gauge("bot_pending_updates", dispatcher.pending)
+metrics.gauge("bot_updates_in_flight", lambda: dispatcher.in_flight)
+metrics.gauge("bot_updates_queued", lambda: dispatcher.queued)
+metrics.counter("bot_rejected_updates_total", lambda: _ingress_counts["rejected"])
+metrics.counter("bot_dropped_updates_total", lambda: [
+    ((("reason", k),), v) for k, v in _dedup.counts.items()])
+metrics.counter("bot_http_pool_connections_total", lambda: [
+    ((("state", "created"),), _pool_stats["connections_created"]),
+    ((("state", "reused"),), _pool_stats["connections_reused"])])
+metrics.gauge("bot_telegram_queued", lambda: [
+    ((("priority", k),), v) for k, v in send_scheduler.queued.items()])
+metrics.gauge("bot_history_rows", lambda: len(price_history))
+metrics.gauge("bot_candle_series", lambda: len(candles.series))
+metrics.counter("bot_inline_answers_total", lambda: [
+    ((("result", "cached"),), inline_catalog.hits), ((("result", "built"),), inline_catalog.misses)])
+metrics.counter("bot_menu_edits_total", lambda: [((("result", k),), v) for k, v in _edit_counts.items()])
+metrics.gauge("bot_alerts_active", lambda: int(alerts.active[: alerts.n].sum()) if alerts.n else 0)
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
 app = Flask(__name__)
 
 @app.get("/")
 def health():
+    if not _ready:
+        return "Bot is starting.", 503
     return "Bot is running."
 
+def _on_loop(fn):
+    # The registries and stats dicts are mutated on the PTB loop; read them
+    # there too, so a WSGI thread never iterates a dict while it grows.
+    async def call():
+        return fn()
+    return asyncio.run_coroutine_threadsafe(call(), _loop).result(timeout=5)
+
+@app.get("/stats")
+def stats():
+    return jsonify(_on_loop(_stats))
+
+@app.get("/metrics")
+def metrics_route():
+    return _on_loop(metrics.render), 200, {"Content-Type": METRICS_CONTENT_TYPE}
+
 @app.post("/webhook")
 def webhook():
     # 1) Validate secret header
@@ -479,26 +2607,104 @@ def webhook():
         log.warning("Rejected webhook: invalid secret token")
         return "forbidden", 403
 
-    # 2) Parse incoming JSON
-    update_json = request.get_json(silent=True) or {}
-
-    # 3) Debug logs: messages vs. callbacks vs. others
-    if "callback_query" in update_json:
-        log.info("💡 FLASK got callback_query: %s", update_json["callback_query"])
-    elif "message" in update_json:
-        log.info("💡 FLASK got message update: %s", update_json["message"])
-    else:
-        log.info("💡 FLASK got other update type: %s", update_json)
+    # 2) Backpressure: Telegram redelivers anything we don't 2xx
+    if not _ready:
+        return "starting", 503
+    if dispatcher.pending() >= UPDATE_QUEUE_SIZE:
+        _ingress_counts["rejected"] += 1
+        return "busy", 503
 
-    # 4) Hand off to PTB
+    # 3) Drop retries and repeated taps, then parse and hand off to PTB
+    update_json = request.get_json(silent=True) or {}
     try:
-        upd = Update.de_json(update_json, tg_app.bot)
-        asyncio.run_coroutine_threadsafe(tg_app.process_update(upd), _loop)
+        # inside the try: a body that isn't an update object must not 500
+        if _dedup.admit(update_json):
+            _loop.call_soon_threadsafe(dispatcher.submit, _parse_update(update_json))
     except Exception as e:
         log.exception("Failed to enqueue update to PTB: %s", e)
 
-    # 5) Always acknowledge fast
+    # 4) Always acknowledge fast
     return "ok", 200
 
 # WSGI entrypoint
 application = app
+
+# ---------- aiohttp app & webhook endpoint (INGRESS=aiohttp) ----------
+# Webhook, health check and PTB share the server's event loop. Updates go
+# to the dispatcher; past UPDATE_QUEUE_SIZE pending the webhook answers 429
+# and a draining server 503, so Telegram backs off and retries.
+_draining = False
+
+async def _aio_health(request: web.Request) -> web.Response:
+    if not _ready:
+        return web.Response(status=503, text="Bot is starting.")
+    return web.Response(text="Bot is running.")
+
+async def _aio_stats(request: web.Request) -> web.Response:
+    return web.json_response(_stats())
+
+async def _aio_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=metrics.render().encode(), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+async def _aio_webhook(request: web.Request) -> web.Response:
+    if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != SECRET_TOKEN:
+        log.warning("Rejected webhook: invalid secret token")
+        return web.Response(status=403, text="forbidden")
+    if _draining or not _ready:
+        return web.Response(status=503, text="starting" if not _ready else "shutting down")
+    if dispatcher.pending() >= UPDATE_QUEUE_SIZE:
+        _ingress_counts["rejected"] += 1
+        return web.Response(status=429, text="busy", headers={"Retry-After": "1"})
+    try:
+        update_json = await request.json()
+        if _dedup.admit(update_json):
+            dispatcher.submit(_parse_update(update_json))
+    except Exception as e:
+        log.exception("Failed to enqueue update to PTB: %s", e)
+    return web.Response(text="ok")
+
+async def _aio_on_startup(webapp: web.Application) -> None:
+    global _loop
+    _loop = asyncio.get_running_loop()
+    await _startup()
+
+async def _aio_on_shutdown(webapp: web.Application) -> None:
+    global _draining
+    _draining = True
+    try:
+        await asyncio.wait_for(dispatcher.join(), DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        log.warning("Drain timed out with %d updates pending", dispatcher.pending())
+    await _shutdown()
+
+async def create_aiohttp_app() -> web.Application:
+    # gunicorn bot_13:create_aiohttp_app --worker-class aiohttp.GunicornWebWorker
+    webapp = web.Application()
+    webapp.router.add_get("/", _aio_health)
+    webapp.router.add_get("/stats", _aio_stats)
+    webapp.router.add_get("/metrics", _aio_metrics)
+    webapp.router.add_post("/webhook", _aio_webhook)
+    webapp.on_startup.append(_aio_on_startup)
+    webapp.on_shutdown.append(_aio_on_shutdown)
+    return webapp
+
+if INGRESS == "flask":
+    _loop = asyncio.new_event_loop()
+    def _run_loop(loop: asyncio.AbstractEventLoop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+    threading.Thread(target=_run_loop, args=(_loop,), daemon=True).start()
+    asyncio.run_coroutine_threadsafe(_startup(), _loop)
+
+    @atexit.register
+    def _on_exit():
+        try:
+            asyncio.run_coroutine_threadsafe(_shutdown(), _loop).result(timeout=10)
+        except Exception as e:
+            log.error("Shutdown error: %s", e)
+
+if __name__ == "__main__":
+    if INGRESS == "aiohttp":
+        web.run_app(create_aiohttp_app(), port=int(os.getenv("PORT") or 8080))
+    else:
+        app.run(port=int(os.getenv("PORT") or 8080))
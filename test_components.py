@@ -0,0 +1,755 @@
+# Deterministic unit tests for bot_13's stateful building blocks.
+# Run with: python -m pytest -q test_components.py
+# No network: INGRESS=aiohttp keeps the import from starting PTB.
+import asyncio
+import math
+import os
+import sys
+import time
+
+os.environ.update(
+    INGRESS="aiohttp",
+    TELEGRAM_TOKEN="123456:TEST",
+    SECRET_TOKEN="test-secret",
+    WEBHOOK_BASE="http://127.0.0.1:9",
+    CRYPTO_API_KEY="http://127.0.0.1:9/crypto",
+    GOLD_API_KEY="http://127.0.0.1:9/gold",
+    SHARED_DIR="",
+    HISTORY_DB="",
+)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pytest
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+
+import bot_13 as b
+
+
+T0 = 1_700_000_040  # a minute boundary
+
+
+# --Token bucket
+def test_token_bucket_burst_then_rate():
+    bucket = b._TokenBucket(rate=2.0, capacity=3)
+    now = bucket.stamp
+    assert [bucket.reserve(now) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve(now) == pytest.approx(0.5)   # one token in debt at 2/s
+    assert bucket.wait_time(now + 0.5) == pytest.approx(0.5)
+    assert bucket.wait_time(now + 1.5) == 0.0
+
+
+def test_token_bucket_refill_is_capped():
+    bucket = b._TokenBucket(rate=10.0, capacity=2)
+    bucket.reserve(bucket.stamp)
+    bucket.wait_time(bucket.stamp + 100)
+    assert bucket.tokens == 2
+
+
+def test_send_scheduler_chat_buckets_are_lru():
+    sched = b._SendScheduler()
+    first = sched._chat_bucket(0)
+    for chat in range(1, 10_000):
+        sched._chat_bucket(chat)
+    assert sched._chat_bucket(0) is first       # touched, so chat 1 is now oldest
+    sched._chat_bucket(10_000)
+    assert len(sched._chats) == 10_000
+    assert 1 not in sched._chats and 0 in sched._chats
+
+
+def test_send_scheduler_drops_superseded_bulk():
+    sched = b._SendScheduler()
+    sent = []
+
+    async def send(text):
+        sent.append(text)
+        return {"ok": text}
+
+    async def run():
+        await sched.initialize()
+        sched._chats[5] = bucket = b._TokenBucket(100, 1)
+        bucket.tokens = 0                     # "old" has to wait, so "new" overtakes it
+        opts = {"priority": "bulk", "coalesce": "alert"}
+        return await asyncio.gather(*(
+            sched.process_request(send, (text,), {}, "sendMessage", {"chat_id": 5}, opts)
+            for text in ("old", "new")))
+
+    assert asyncio.run(run()) == [{}, {"ok": "new"}]
+    assert sent == ["new"] and sched.counts["superseded"] == 1
+
+
+# --Snapshot cache
+class _GatedFetch:
+    def __init__(self, *values):
+        self.values, self.calls, self.gate = list(values), 0, None
+
+    async def __call__(self):
+        self.calls += 1
+        if self.gate is not None:
+            await self.gate.wait()
+        return self.values.pop(0)
+
+
+def _aged(cache, value, age):
+    cache.value, cache.fetched_at = value, time.monotonic() - age
+
+
+def test_cache_misses_share_one_fetch():
+    fetch = _GatedFetch("v1")
+    cache = b._SnapshotCache("t", fetch, ttl=30, max_stale=300)
+    seen = []
+    cache.subscribe(lambda value, version: seen.append((value, version)))
+
+    async def run():
+        fetch.gate = asyncio.Event()
+        waiters = [asyncio.ensure_future(cache.get()) for _ in range(5)]
+        await asyncio.sleep(0)
+        waiters[0].cancel()                  # one caller gives up; the fetch carries on
+        fetch.gate.set()
+        return await asyncio.gather(*waiters[1:])
+
+    assert asyncio.run(run()) == ["v1"] * 4
+    assert fetch.calls == 1 and seen == [("v1", 1)]
+    assert cache.info()["misses"] == 5
+    assert asyncio.run(cache.get()) == "v1" and cache.hits == 1
+
+
+def test_cache_serves_stale_while_one_refresh_runs():
+    fetch = _GatedFetch("new")
+    cache = b._SnapshotCache("t", fetch, ttl=30, max_stale=300)
+    _aged(cache, "old", 40)
+
+    async def run():
+        fetch.gate = asyncio.Event()
+        first = await cache.get()
+        second = await cache.get()            # refresh already in flight
+        await asyncio.sleep(0)
+        fetch.gate.set()
+        await cache._inflight
+        return first, second, await cache.get()
+
+    assert asyncio.run(run()) == ("old", "old", "new")
+    assert fetch.calls == 1 and (cache.stale_hits, cache.hits, cache.version) == (2, 1, 1)
+
+
+def test_cache_falls_back_to_the_last_good_value():
+    cache = b._SnapshotCache("t", _GatedFetch(None, None), ttl=30, max_stale=300)
+    assert asyncio.run(cache.get()) is None              # nothing to fall back to
+    _aged(cache, "old", 1000)
+    assert asyncio.run(cache.get()) == "old"
+    assert (cache.fallbacks, cache.misses, cache.version) == (1, 2, 0)
+
+
+def test_cache_listener_errors_do_not_stop_the_others():
+    cache = b._SnapshotCache("t", _GatedFetch("v"), ttl=30, max_stale=300)
+    seen = []
+    cache.subscribe(lambda value, version: 1 / 0)
+    cache.subscribe(lambda value, version: seen.append(value))
+    assert asyncio.run(cache.get()) == "v" and seen == ["v"]
+
+
+# --Circuit breaker
+def test_breaker_state_machine():
+    clock = [1000.0]
+    br = b._CircuitBreaker("t", failures=2, reset=30, clock=lambda: clock[0])
+    br.failure()
+    assert br.state == "closed" and br.allow()
+    br.failure()
+    assert br.state == "open" and not br.allow()
+    clock[0] += 30
+    assert br.allow() and br.state == "half_open"
+    assert not br.allow()                       # one probe at a time
+    br.failure()
+    assert br.state == "open" and br.opened == 2
+    clock[0] += 30
+    assert br.allow()
+    br.success()
+    assert br.state == "closed" and br.consecutive == 0 and br.allow()
+    assert br.info()["rejected"] == 2
+
+
+def test_breaker_cancelled_probe_frees_the_slot(monkeypatch):
+    clock = [1000.0]
+    br = b._CircuitBreaker("t", failures=1, reset=30, clock=lambda: clock[0])
+    monkeypatch.setitem(b._breakers, "t", br)
+    br.failure()
+    clock[0] += 30
+
+    async def hang(name, url):
+        await asyncio.sleep(3600)
+
+    monkeypatch.setattr(b, "_hedged", hang)
+
+    async def run():
+        task = asyncio.ensure_future(b._fetch_upstream("t", "http://x", lambda body: body))
+        await asyncio.sleep(0)
+        assert br.state == "half_open" and not br.allow()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert br.state == "half_open" and br.allow()   # next tick may probe again
+
+
+def test_raw_bodies_kept_by_the_leader_only(monkeypatch):
+    monkeypatch.setitem(b._breakers, "t", b._CircuitBreaker("t", failures=3, reset=30))
+    monkeypatch.setattr(b, "_raw_bodies", {})
+
+    async def body(name, url):
+        return b'{"ok": 1}'
+
+    monkeypatch.setattr(b, "_hedged", body)
+    monkeypatch.setattr(b, "_role", "single")
+    assert asyncio.run(b._fetch_upstream("t", "http://x", lambda raw: raw)) == b'{"ok": 1}'
+    assert b._raw_bodies == {}
+    monkeypatch.setattr(b, "_role", "leader")
+    asyncio.run(b._fetch_upstream("t", "http://x", lambda raw: raw))
+    assert b._raw_bodies == {"t": b'{"ok": 1}'}
+
+
+# --Metrics
+def test_metrics_render_types_every_family_once():
+    m = b._Metrics()
+    m.inc("x_total", (("a", "1"),))
+    m.inc("x_total", (("a", "2"),), 2)
+    m.observe("x_seconds", 0.02)
+    m.gauge("x_depth", lambda: 3)
+    m.counter("x_hits_total", lambda: [((("r", "hit"),), 5), ((("r", "miss"),), 1)])
+    m.gauge("x_broken", lambda: 1 / 0)
+    lines = m.render().splitlines()
+    types = {line.split()[2]: line.split()[3] for line in lines if line.startswith("# TYPE")}
+    assert types == {"x_total": "counter", "x_seconds": "histogram",
+                     "x_depth": "gauge", "x_hits_total": "counter"}
+    for name in types:   # the TYPE line comes right before the family's samples
+        first = next(k for k, line in enumerate(lines) if line.startswith(name))
+        assert lines[first - 1] == f"# TYPE {name} {types[name]}"
+    assert 'x_hits_total{r="hit"} 5' in lines and 'x_seconds_bucket{le="+Inf"} 1' in lines
+
+
+def test_bot_totals_are_exported_as_counters():
+    types = dict(line.split()[2:4] for line in b.metrics.render().splitlines() if line.startswith("# TYPE"))
+    assert {n: t for n, t in types.items() if n.endswith("_total")} == {
+        n: "counter" for n in types if n.endswith("_total")}
+    assert types["bot_cache_requests_total"] == types["bot_dropped_updates_total"] == "counter"
+    assert types["bot_pending_updates"] == "gauge"
+
+
+# --Flask reads
+def test_flask_stats_render_on_the_loop(monkeypatch):
+    import threading
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(b, "_loop", loop)
+    try:
+        assert b._on_loop(threading.current_thread) is thread
+        body = b.app.test_client().get("/metrics").get_data(as_text=True)
+        assert "bot_snapshot_leader" in body
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def test_flask_webhook_acks_bodies_that_are_not_updates(monkeypatch):
+    monkeypatch.setattr(b, "_ready", True)
+    monkeypatch.setattr(b, "_dedup", b._UpdateDeduper())
+    submitted = []
+    loop = type("Loop", (), {"call_soon_threadsafe": staticmethod(lambda fn, upd: submitted.append(upd))})
+    monkeypatch.setattr(b, "_loop", loop)
+    client = b.app.test_client()
+    headers = {"X-Telegram-Bot-Api-Secret-Token": b.SECRET_TOKEN}
+    for body in ([1, 2], "x", {"update_id": 9, "callback_query": [1]}):
+        assert client.post("/webhook", json=body, headers=headers).status_code == 200
+    assert submitted == []
+    assert client.post("/webhook", json={"update_id": 10}, headers=headers).status_code == 200
+    assert [u.update_id for u in submitted] == [10]
+
+
+# --Shared snapshot seqlock
+def test_shared_snapshot_roundtrip(tmp_path):
+    snap = b._SharedSnapshot(str(tmp_path / "crypto.snap"), b._parse_crypto)
+    assert snap.read() is None and snap.version() == 0
+    snap.publish(b'{"data": [{"symbol": "BTC", "p": "1,000.5"}]}')
+    assert snap.version() == 1
+    reader = b._SharedSnapshot(str(tmp_path / "crypto.snap"), b._parse_crypto)
+    (coin,) = reader.read()
+    assert (coin.symbol, coin.p) == ("BTC", 1000.5)
+    snap.publish(b'{"data": []}')
+    assert reader.version() == 2 and reader.read() == []
+
+
+def test_shared_snapshot_write_in_progress_reads_none(tmp_path):
+    snap = b._SharedSnapshot(str(tmp_path / "gold.snap"), b._parse_gold)
+    snap.publish(b'{"current": {"geram18": {"p": "5"}}}')
+    magic, seq, n, ts = b._SNAP_HEADER.unpack_from(snap._mm, 0)
+    b._SNAP_HEADER.pack_into(snap._mm, 0, magic, seq + 1, n, ts)  # writer mid-publish
+    assert snap.read() is None
+    snap.publish(b'{"current": {"geram18": {"p": "6"}}}')  # recovers from the odd seq
+    assert snap.read()["geram18"].p == 6.0
+
+
+# --Alert hysteresis and cooldown
+def test_alert_fires_once_then_rearms_past_band(monkeypatch):
+    monkeypatch.setattr(b, "ALERT_HYSTERESIS", 0.01)
+    monkeypatch.setattr(b, "ALERT_COOLDOWN", 0)
+    table = b._AlertTable()
+    i = table.add(7, "BTC", 1, 100.0)
+    sid = table.sym[i]
+    np = b._numpy()
+
+    def tick(price, now):
+        prices = np.full(len(table.names), math.nan)
+        prices[sid] = price
+        return table.evaluate(prices, now).tolist()
+
+    assert tick(99, 1) == []
+    assert tick(100, 2) == [i]
+    assert tick(101, 3) == []        # still beyond, disarmed
+    assert tick(99.5, 4) == []       # back inside the 1% band: not re-armed yet
+    assert tick(100, 5) == []
+    assert tick(98.9, 6) == []       # past the band: re-armed
+    assert tick(100, 7) == [i]
+
+
+def test_alert_cooldown_and_remove(monkeypatch):
+    monkeypatch.setattr(b, "ALERT_HYSTERESIS", 0.0)
+    monkeypatch.setattr(b, "ALERT_COOLDOWN", 60)
+    table = b._AlertTable()
+    i = table.add(7, "geram18", -1, 50.0)
+    np = b._numpy()
+    low, high = np.array([40.0]), np.array([60.0])
+    assert table.evaluate(low, 0).tolist() == [i]
+    table.evaluate(high, 1)
+    assert table.evaluate(low, 30).tolist() == []   # re-armed but cooling down
+    assert table.evaluate(low, 61).tolist() == [i]
+    assert not table.remove(8, i) and table.remove(7, i)
+    assert table.for_chat(7) == []
+
+
+def test_alert_command_rejects_unknown_symbols(monkeypatch):
+    replies = []
+    msg = type("Msg", (), {"reply_text": staticmethod(lambda text: _record(replies, text))})()
+    update = type("U", (), {"effective_chat": type("C", (), {"id": 7})(), "effective_message": msg})()
+    fetched = []
+
+    async def crypto():
+        fetched.append("crypto")
+        b._alert_prices["BTC"] = 100.0
+        return []
+
+    async def gold():
+        return {}
+
+    monkeypatch.setattr(b, "_alert_prices", {})
+    monkeypatch.setattr(b, "alerts", b._AlertTable())
+    monkeypatch.setattr(b, "_alert_store", None)
+    monkeypatch.setattr(b, "_alert_polling", True)
+    monkeypatch.setattr(b, "get_crypto_data", crypto)
+    monkeypatch.setattr(b, "fetch_gold_data", gold)
+
+    def run(*args):
+        asyncio.run(b.alert(update, type("Ctx", (), {"args": list(args)})()))
+        return replies[-1]
+
+    assert run("DOGEX", ">", "1").startswith("Unknown symbol DOGEX.")
+    assert run("btc", ">", "150") == "✅ Alert #0: BTC > 150"
+    assert run("BTC", "<", "150").endswith("already past it: fires on the next crossing")
+    assert fetched == ["crypto"]              # known names don't refetch
+    assert b.alerts.names == ["BTC"]
+
+
+async def _record(replies, text):
+    replies.append(text)
+
+
+def test_alert_added_beyond_threshold_waits_for_a_crossing(monkeypatch):
+    monkeypatch.setattr(b, "ALERT_HYSTERESIS", 0.0)
+    monkeypatch.setattr(b, "ALERT_COOLDOWN", 0)
+    table = b._AlertTable()
+    i = table.add(7, "BTC", 1, 100.0, price=120.0)
+    j = table.add(7, "BTC", -1, 100.0, price=120.0)
+    np = b._numpy()
+    assert table.evaluate(np.array([121.0]), 1).tolist() == []
+    assert table.evaluate(np.array([90.0]), 2).tolist() == [j]
+    assert table.evaluate(np.array([101.0]), 3).tolist() == [i]
+
+
+def test_first_alert_starts_the_pollers(monkeypatch):
+    started = []
+
+    async def poll(cache, base):
+        started.append((cache.name, base))
+
+    monkeypatch.setattr(b, "_poll", poll)
+    monkeypatch.setattr(b, "_alert_polling", False)
+    monkeypatch.setattr(b, "POLL_INTERVAL", 0)
+    monkeypatch.setattr(b, "_bg_tasks", [])
+    monkeypatch.setattr(b, "_alert_store", None)
+    monkeypatch.setattr(b, "alerts", b._AlertTable())
+
+    async def run():
+        await b._add_alert(1, "BTC", 1, 1.0)
+        await b._add_alert(2, "BTC", 1, 2.0)
+        await asyncio.gather(*b._bg_tasks)
+
+    asyncio.run(run())
+    assert started == [("crypto", b.CACHE_TTL), ("gold", b.CACHE_TTL)]
+
+
+class _GatedBot:
+    # send_message parks on a gate, like a bulk send waiting for tokens
+    def __init__(self):
+        self.sent, self.gate = [], None
+
+    async def send_message(self, chat_id, text, rate_limit_args=None):
+        await self.gate.wait()
+        self.sent.append((chat_id, text))
+
+
+def test_fired_alerts_keep_their_chat_while_sends_wait(monkeypatch):
+    monkeypatch.setattr(b, "ALERT_COOLDOWN", 0)
+    monkeypatch.setattr(b, "_alert_prices", {"BTC": 150.0})
+    monkeypatch.setattr(b, "alerts", b._AlertTable())
+    bot = _GatedBot()
+    monkeypatch.setattr(b, "tg_app", type("App", (), {"bot": bot}))
+    b.alerts.add(1, "BTC", 1, 100.0)
+    i = b.alerts.add(2, "BTC", 1, 120.0)
+
+    async def run():
+        bot.gate = asyncio.Event()
+        b._check_alerts()
+        await asyncio.sleep(0)
+        # chat 2 deletes its alert mid-send and chat 99 takes the freed row
+        assert b.alerts.remove(2, i) and b.alerts.add(99, "BTC", -1, 5.0) == i
+        bot.gate.set()
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert [(chat, text.splitlines()[0]) for chat, text in bot.sent] == [
+        (1, "🔔 BTC >= 100"), (2, "🔔 BTC >= 120")]
+
+
+
+def test_fired_alerts_survive_a_store_sync_swap(monkeypatch):
+    monkeypatch.setattr(b, "ALERT_COOLDOWN", 0)
+    monkeypatch.setattr(b, "_alert_prices", {"BTC": 100.0, "ETH": 1.0})
+    monkeypatch.setattr(b, "alerts", b._AlertTable())
+    bot = _GatedBot()
+    monkeypatch.setattr(b, "tg_app", type("App", (), {"bot": bot}))
+    b._mirror_alerts([(11, 2, "BTC", 1, 120.0)])
+    b._alert_prices["BTC"] = 150.0
+
+    async def run():
+        bot.gate = asyncio.Event()
+        b._check_alerts()
+        # another worker's changes land before the send goes out: new names, new rows
+        b._mirror_alerts([(12, 3, "ETH", -1, 5.0), (11, 2, "BTC", 1, 120.0)])
+        bot.gate.set()
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert bot.sent == [(2, "🔔 BTC >= 120\nnow: 150  (#11)")]
+
+
+# --Search index
+def _coin(symbol, title, p=1.0):
+    return b.Coin(title, symbol, p, p * 10, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, "")
+
+
+COINS = [_coin("BTCST", "BTC Standard Hashrate"), _coin("BCH", "Bitcoin Cash"),
+         _coin("BTC", "Bitcoin"), _coin("WBTC", "Wrapped Bitcoin"), _coin("ETH", "Ethereum")]
+
+
+def test_symbol_index_ranking():
+    index = b._SymbolIndex(COINS, 1)
+    syms = lambda q, **kw: [c.symbol for c in index.lookup(q, **kw)]
+    assert syms("btc") == ["BTC", "BTCST"]                  # exact, then shorter prefix first
+    assert syms("bitcoin") == ["BCH", "BTC", "WBTC"]        # whole words in snapshot order
+    assert syms("wrapped") == ["WBTC"]
+    assert syms("ETHH") == ["ETH"]                          # typo falls back to fuzzy
+    assert syms("bitc", limit=2) == ["BCH", "BTC"]
+    assert syms("  ") == [] and syms("zzzz") == []
+
+
+def test_symbol_index_multi_word_titles():
+    index = b._SymbolIndex(COINS + [_coin("SHIB", "Shiba-Inu")], 1)
+    syms = lambda q: [c.symbol for c in index.lookup(q)]
+    assert syms("bitcoin cash") == syms("bitcoin-cash") == syms("BITCOIN  CASH") == ["BCH"]
+    assert syms("shiba inu") == syms("shiba-inu") == syms("inu") == ["SHIB"]
+
+
+def test_search_pages_and_joins_words(monkeypatch):
+    coins = [_coin(f"AB{i:02d}", f"Alpha Beta {i}") for i in range(12)]
+    index = b._SymbolIndex(coins, 1)
+
+    async def data():
+        return coins
+
+    monkeypatch.setattr(b, "SEARCH_PAGE_SIZE", 5)
+    monkeypatch.setattr(b, "_search_index", index)
+    monkeypatch.setattr(b, "get_crypto_data", data)
+    text, markup = asyncio.run(b._render_search("alpha beta", 3))
+    assert "📄 3/3" in text and text.count("AB1") == 2    # AB10, AB11
+    assert [btn.callback_data for btn in markup.inline_keyboard[0]] == ["search:2:alpha beta"]
+    text, markup = asyncio.run(b._render_search("alpha beta", 9))   # clamped to the last page
+    assert "📄 3/3" in text
+    text, markup = asyncio.run(b._render_search("ab00"))
+    assert markup is None and "📄" not in text
+
+    queries = []
+
+    async def page(message, query, page=1):
+        queries.append((query, page))
+
+    monkeypatch.setattr(b, "_search_page", page)
+    update = type("U", (), {"effective_message": None})()
+    asyncio.run(b.search(update, type("Ctx", (), {"args": ["bitcoin", "cash", "2"]})()))
+    assert queries == [("bitcoin cash", 2)]
+
+
+# --Price history ring
+def _snap(stamp, **prices):
+    return [b.Coin(sym, sym, p, p * 10, 1.0, 0, 0, 0, 0, 0, stamp) for sym, p in prices.items()]
+
+
+def test_history_ring_wraps_and_keeps_the_newest_rows():
+    h = b._PriceHistory(max_rows=5, retention=10**9)
+    for k in range(4):
+        assert h.add_snapshot(_snap(f"s{k}", BTC=k, ETH=k + 0.5), now=T0 + k)
+    assert len(h) == 5 and h.info()["max_rows"] == 5
+    rows = list(h.rows())
+    assert [(ts - T0, sym, p) for ts, sym, p, _, _ in rows] == [
+        (1, "ETH", 1.5), (2, "BTC", 2), (2, "ETH", 2.5), (3, "BTC", 3), (3, "ETH", 3.5)]
+    assert [r[1] for r in h.rows(symbols=["btc"])] == ["BTC", "BTC"]
+    assert [r[0] - T0 for r in h.rows(since=T0 + 3)] == [3, 3]
+
+
+def test_history_ignores_rows_past_retention():
+    now = time.time()
+    h = b._PriceHistory(max_rows=10, retention=600)
+    h.add_snapshot(_snap("a", BTC=1), now=now - 1000)
+    h.add_snapshot(_snap("b", BTC=2), now=now - 100)
+    assert [r[2] for r in h.rows()] == [2]
+    assert h.span(now) == 600 and len(h) == 2    # still stored, just not served
+
+
+def test_history_skips_repeated_and_too_frequent_snapshots():
+    h = b._PriceHistory(max_rows=10, retention=10**9, interval=300)
+    assert h.add_snapshot(_snap("a", BTC=1), now=T0)
+    assert not h.add_snapshot(_snap("a", BTC=1), now=T0 + 400)     # upstream didn't move
+    assert not h.add_snapshot(_snap("b", BTC=2), now=T0 + 100)     # within the interval
+    assert h.add_snapshot(_snap("b", BTC=2), now=T0 + 300)
+    assert (h.skipped, h.throttled, len(h)) == (1, 1, 2)
+    assert h.span(now=T0 + 300) == 300
+
+
+def test_history_frozen_copy_is_independent():
+    h = b._PriceHistory(max_rows=4, retention=10**9)
+    h.add_snapshot(_snap("a", BTC=1), now=T0)
+    copy = h.frozen()
+    h.add_snapshot(_snap("b", BTC=2, XRP=3), now=T0 + 1)
+    assert [r[1:3] for r in copy.rows()] == [("BTC", 1)]
+    assert len(list(h.rows())) == 3
+
+
+def test_history_defaults_cover_the_retention():
+    per_snapshot = max(b.HISTORY_INTERVAL, b.CACHE_TTL)
+    if "HISTORY_MAX_ROWS" not in os.environ:
+        assert b.HISTORY_MAX_ROWS * per_snapshot >= b.HISTORY_RETENTION * b.HISTORY_SYMBOLS
+
+
+# --Export sharing
+def test_overlapping_identical_exports_share_one_file(monkeypatch):
+    import threading
+    h = b._PriceHistory(max_rows=10, retention=10**9)
+    h.add_snapshot(_snap("a", BTC=1, ETH=2))
+    monkeypatch.setattr(b, "price_history", h)
+    release, calls, real = threading.Event(), [], b._write_export
+
+    def write(*args):
+        calls.append(args[1])
+        release.wait(5)
+        return real(*args)
+
+    monkeypatch.setattr(b, "_write_export", write)
+    sent = []
+
+    async def reply_document(document, filename, caption):
+        sent.append((filename, document.read().decode().splitlines(), caption, document.name))
+
+    msg = type("Msg", (), {"reply_document": staticmethod(reply_document)})()
+    update = type("U", (), {"effective_message": msg})()
+
+    async def run():
+        ctx = type("Ctx", (), {"args": ["csv"]})()
+        tasks = [asyncio.ensure_future(b.excel_file(update, ctx)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert calls == ["csv"] and len(sent) == 2 and not b._exports
+    (name, lines, caption, path), second = sent
+    assert name == "telegram_bot_data.csv" and second[3] == path and not os.path.exists(path)
+    assert lines[0] == ",".join(b.EXPORT_COLUMNS) and len(lines) == 3
+    assert caption.startswith("دریافت اکسل: 2 ردیف")
+
+
+# --Gold views
+def test_gold_views_render_once_per_snapshot(monkeypatch):
+    d = {"geram18": b.Quote(40_000_000.0, "طلای 18", "12:00"), "geram24": b.Quote(53_000_000.0, "", "")}
+    monkeypatch.setattr(b, "_view_texts", {})
+
+    async def gold():
+        return d
+
+    monkeypatch.setattr(b, "fetch_gold_data", gold)
+    b._render_views(d, 1)
+    lines = asyncio.run(b._render_gold_view("goldprice")).splitlines()
+    assert lines[:2] == ["قیمت طلا طلای 18", "12:00"]
+    assert lines[2] == f"18 ایار: {b._fmt_num(40_000_000.0)}" and lines[4] == "مثقال: "
+    assert asyncio.run(b._render_gold_view("goldons")) == "No data found."   # header key missing
+    monkeypatch.setattr(b, "_view_texts", {})
+    assert asyncio.run(b._render_gold_view("goldprice")) == "No data found."
+
+
+# --Inline catalog
+def test_inline_catalog_prefix_ranking_and_cache(monkeypatch):
+    cat = b._InlineCatalog(limit=3, cache_max=2)
+    monkeypatch.setattr(b, "inline_catalog", cat)
+    b._inline_crypto(COINS, 1)
+    b._inline_gold({"price_dollar_rl": b.Quote(600_000.0, "دلار", "12:00"),
+                    "price_eur": b.Quote(650_000.0, "", "")}, 1)
+    ids = lambda q: [a.id for a in cat.lookup(q)]
+    assert ids("btc") == ["c1:0", "c1:2"]                   # BTCST's title has the word too
+    assert ids("bitc") == ["c1:1", "c1:2", "c1:3"]          # capped at the limit
+    assert ids("bitcoin cash") == ["c1:1"]
+    assert ids("dollar") == ["g1:price_dollar_rl"]
+    assert ids("") == ["c1:0", "c1:1", "c1:2"]              # featured, capped at the limit
+    assert cat.info()["articles"] == 5                      # only what was returned was built
+    first = cat.lookup("btc")                               # evicted by the last two queries
+    assert cat.lookup("btc") is first and (cat.hits, cat.misses) == (1, 6)
+    assert cat.info()["cached_queries"] == 2
+    b._inline_crypto(COINS[:1], 2)                          # new snapshot drops cached answers
+    assert cat.info()["cached_queries"] == 0 and ids("btc") == ["c2:0"]
+
+
+# --Candles
+
+
+def test_candles_ohlc_and_rollover():
+    agg = b._Aggregator(keep=3, resolutions={"1m": 60})
+    for ts, price in [(0, 10), (10, 12), (20, 9), (30, 11), (60, 20)]:
+        agg.observe("crypto", ts, [("BTC", price)], now=T0 + ts)
+    s = agg.summary("BTC", "1m", now=T0 + 60)
+    assert s["candles"] == [(T0, 10, 12, 9, 11), (T0 + 60, 20, 20, 20, 20)]
+    assert (s["min"], s["max"], s["observations"]) == (9, 20, 5)
+    assert s["mean"] == pytest.approx(62 / 5)
+    assert s["change"] == pytest.approx(100.0)
+    # three minutes on the first candle's slot has been reused; the window keeps 3
+    agg.observe("crypto", "late", [("BTC", 30)], now=T0 + 180)
+    assert [c[0] for c in agg.summary("BTC", "1m", now=T0 + 180)["candles"]] == [T0 + 60, T0 + 180]
+
+
+def test_candles_skip_repeated_snapshot_and_bad_prices():
+    agg = b._Aggregator(keep=4, resolutions={"1m": 60})
+    assert agg.observe("gold", "k1", [("geram18", 5.0), ("nim", math.nan)], now=T0)
+    assert not agg.observe("gold", "k1", [("geram18", 6.0)], now=T0 + 1)
+    assert agg.lookup("GERAM18") == "geram18" and agg.lookup("nim") is None
+    assert agg.summary("geram18", "1m", now=T0 + 1)["observations"] == 1
+
+
+# --Webhook dedup
+def test_deduper_drops_redelivery_and_repeated_taps():
+    d = b._UpdateDeduper()
+    tap = {"callback_query": {"data": "top", "message": {"chat": {"id": 1}}}}
+    assert d.admit({"update_id": 1, **tap})
+    assert not d.admit({"update_id": 1, **tap})
+    assert not d.admit({"update_id": 2, **tap})          # same button, same chat
+    assert d.admit({"update_id": 3, "callback_query": {"data": "top", "message": {"chat": {"id": 2}}}})
+    assert d.counts == {"duplicate_updates": 1, "coalesced_callbacks": 1}
+
+
+def test_shared_update_ids_across_instances(tmp_path):
+    a = b._SharedUpdateIds(str(tmp_path / "ids"), 100)
+    other = b._SharedUpdateIds(str(tmp_path / "ids"), 100)
+    assert not a.seen(5) and other.seen(5)
+    assert not other.seen(105)   # same slot, newer id evicts
+    assert not a.seen(5)
+
+
+# --In-place menu edits
+class _FakeQuery:
+    def __init__(self, text, markup=None):
+        self.message = type("M", (), {})()
+        self.message.chat = type("C", (), {"id": 1})()
+        self.message.message_id = 10
+        self.message.text = text
+        self.message.reply_markup = markup
+        self.edits = []
+
+    async def edit_message_text(self, text, reply_markup=None):
+        self.edits.append(text)
+
+
+def test_edit_in_place_skips_unchanged_content(monkeypatch):
+    monkeypatch.setattr(b, "_last_edit", b.OrderedDict())
+    markup = InlineKeyboardMarkup([[InlineKeyboardButton("x", callback_data="x")]])
+    q = _FakeQuery("menu", markup)
+    asyncio.run(b._edit_in_place(q, "menu", markup))      # already on screen
+    asyncio.run(b._edit_in_place(q, "prices", markup))
+    asyncio.run(b._edit_in_place(q, "prices", markup))    # remembered from last edit
+    asyncio.run(b._edit_in_place(q, "menu", markup))
+    assert q.edits == ["prices", "menu"]
+
+
+def test_menu_alert_and_history_buttons_show_usage(monkeypatch):
+    monkeypatch.setattr(b, "_last_edit", b.OrderedDict())
+    buttons = {btn.callback_data for row in b.MENU_MARKUP.inline_keyboard for btn in row}
+    assert {"alert", "history"} <= buttons
+    q = _FakeQuery(b.MENU_TEXT, b.MENU_MARKUP)
+
+    async def answer():
+        pass
+
+    q.answer = answer
+    for data, prompt in (("alert", b.ALERT_PROMPT), ("history", b.HISTORY_PROMPT)):
+        q.data = data
+        asyncio.run(b.on_callback(type("U", (), {"callback_query": q})(), None))
+        assert q.edits[-1] == prompt
+
+
+# --Per-chat dispatch
+def _message(uid, chat):
+    return Update.de_json({"update_id": uid, "message": {
+        "message_id": uid, "date": 0, "text": "x", "chat": {"id": chat, "type": "private"}}}, None)
+
+
+def test_dispatcher_orders_within_chat_and_overlaps_chats(monkeypatch):
+    log, running = [], set()
+
+    async def process_update(upd):
+        chat = upd.effective_chat.id
+        running.add(chat)
+        log.append((chat, upd.update_id, frozenset(running)))
+        await asyncio.sleep(0.02 if chat == 1 else 0.001)
+        running.discard(chat)
+
+    monkeypatch.setattr(b, "tg_app", type("App", (), {"process_update": staticmethod(process_update)}))
+
+    async def run():
+        d = b._ChatDispatcher(limit=4)
+        for uid, chat in [(1, 1), (2, 1), (3, 2), (4, 1), (5, 2)]:
+            d.submit(_message(uid, chat))
+        assert d.pending() == 5
+        await d.join()
+        return d
+
+    d = asyncio.run(run())
+    assert [u for c, u, _ in log if c == 1] == [1, 2, 4]
+    assert [u for c, u, _ in log if c == 2] == [3, 5]
+    assert any(len(r) > 1 for _, _, r in log)    # chats really ran side by side
+    assert d.info()["processed"] == 5 and d.pending() == 0